@@ -1,159 +1,717 @@
+import argparse
+import asyncio
 import csv
 import json
+import logging
+import os
+import random
 import urllib.parse
+import zlib
+from array import array
+from collections import Counter
+from itertools import compress
 from pathlib import Path
-from typing import Tuple, Set
-from urllib.parse import urlparse
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import requests
-from joblib import Parallel, delayed
+
+from page_store import ALIASES_SUFFIX
+from rate_limit import RATE_CONTROLLERS, TokenBucket, parse_retry_after
+
+try:
+    import aiohttp
+except ImportError:  # Only required for the CDX crawler
+    aiohttp = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Without pyarrow, checkpoints are stored as csv
+    pyarrow = None
 
 
 class CDXRecord(object):
-    def __init__(self, timestamp, url):
-        self.timestamp = timestamp
+    __slots__ = ("timestamp", "url", "digest")
+
+    def __init__(self, timestamp, url, digest: str = ''):
+        # Timestamps always have 14 digits, i.e. 20180806145630, thus fit in a 64 bit integer
+        self.timestamp = int(timestamp)
         self.url = url
+        # Digest of the captured content, if requested
+        self.digest = digest
+
+    def __eq__(self, other):
+        return isinstance(other, CDXRecord) and self.timestamp == other.timestamp and self.url == other.url
 
     def __hash__(self):
         return hash((self.timestamp, self.url))
 
+    def __repr__(self):
+        return f"CDXRecord({self.timestamp}, {self.url!r})"
+
+
+class CDXRecords(object):
+    __slots__ = ("timestamps", "urls", "digests")
+
+    def __init__(self, timestamps: array = None, urls: List[str] = None, digests: List[str] = None):
+        """
+        Column-wise list of CDX records, which avoids the overhead of an object per record.
+
+        :param timestamps: Timestamps as 64 bit integers.
+        :param urls: Urls, in the same order as the timestamps.
+        :param digests: Digests of the captured content, empty if not requested. Defaults to empty digests.
+        """
+        self.timestamps = timestamps if timestamps is not None else array('q')
+        self.urls = urls if urls is not None else []
+        self.digests = digests if digests is not None else [''] * len(self.urls)
+
+    def append(self, timestamp: int, url: str, digest: str = '') -> None:
+        self.timestamps.append(timestamp)
+        self.urls.append(url)
+        self.digests.append(digest)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self) -> Iterator[CDXRecord]:
+        for timestamp, url, digest in zip(self.timestamps, self.urls, self.digests):
+            yield CDXRecord(timestamp, url, digest)
+
+
+PART_SUFFIX = ".parquet" if pyarrow is not None else ".csv"
+
+
+def write_part(path: Path, records: CDXRecords) -> None:
+    """
+    Write a part of a records checkpoint, as Parquet if pyarrow is installed and as csv otherwise.
+
+    :param path: Path to the part, without suffix.
+    :param records: Records of the part.
+    """
+    path = path.with_suffix(PART_SUFFIX)
+    temp_path = path.with_suffix('.tmp')
+    if pyarrow is not None:
+        table = pyarrow.table({'timestamp': pyarrow.array(records.timestamps, type=pyarrow.int64()),
+                               'url': pyarrow.array(records.urls, type=pyarrow.string()),
+                               'digest': pyarrow.array(records.digests, type=pyarrow.string())})
+        pyarrow.parquet.write_table(table, str(temp_path), compression='zstd')
+    else:
+        with open(temp_path, 'w', newline='') as file:
+            csv.writer(file).writerows(zip(records.timestamps, records.urls, records.digests))
+    os.replace(str(temp_path), str(path))
+
+
+def read_part(path: Path) -> CDXRecords:
+    """
+    Read a part of a records checkpoint.
+
+    :param path: Path to the part.
+    :return: Records of the part.
+    """
+    if path.suffix == '.parquet':
+        if pyarrow is None:
+            raise ImportError("Reading Parquet checkpoints requires pyarrow, install it using 'pip install pyarrow'")
+        table = pyarrow.parquet.read_table(str(path))
+        digests = table.column('digest').to_pylist() if 'digest' in table.column_names else None
+        return CDXRecords(array('q', table.column('timestamp').to_pylist()), table.column('url').to_pylist(), digests)
+
+    records = CDXRecords()
+    with open(path, 'r', newline='') as file:
+        # Parts of older versions have no digests
+        for row in csv.reader(file):
+            records.append(int(row[0]), row[1], row[2] if len(row) > 2 else '')
+    return records
+
+
+# Extensions of urls that are likely to be html pages, next to urls without extension. As only the last 5 characters
+# of a path are considered, longer extensions such as .international never match.
+HTML_EXTENSIONS = frozenset(['.ae', '.aero', '.br', '.by', '.ca', '.cern', '.ch', '.com', '.cr', '.dk', '.es', '.et',
+                             '.eu', '.fi', '.fj', '.info', '.int', '.international', '.is', '.jm', '.mk', '.my', '.ne',
+                             '.net', '.org', '.pl', '.qa', '.ru', '.se',
+
+                             '.html', '.htm', '.php'])
+
+
+def filter_html_urls(records: CDXRecords, kept: Counter = None, dropped: Counter = None) -> CDXRecords:
+    """
+    Keep the records of which the url is likely to be a html page, judged by the extension in the last 5 characters
+    of the path. A list comprehension over the url column slices off the extension of every url, which is looked up in
+    a set. pandas and Arrow string operations were not faster on this, as the urls are Python strings already.
+
+    :param records: Records to filter.
+    :param kept: Counter to add the amount of kept records per extension to.
+    :param dropped: Counter to add the amount of dropped records per extension to.
+    :return: Records that have been kept.
+    """
+    tails = [url.partition('?')[0].partition('#')[0][-5:] for url in records.urls]
+    extensions = [tail[tail.rfind('.'):] if '.' in tail else '' for tail in tails]
+    mask = [not extension or extension in HTML_EXTENSIONS for extension in extensions]
+
+    if kept is not None:
+        kept.update(compress(extensions, mask))
+    if dropped is not None:
+        dropped.update(extension for extension, keep in zip(extensions, mask) if not keep)
+
+    return CDXRecords(array('q', compress(records.timestamps, mask)), list(compress(records.urls, mask)),
+                      list(compress(records.digests, mask)))
+
+
+def skip_duplicate_digests(records: CDXRecords, seen: Dict[str, Tuple[int, str]],
+                           aliases: List[Tuple[int, str, str, int, str]]) -> CDXRecords:
+    """
+    Skip the records of which the captured content is identical to a record seen before, either of another url or of
+    the same url in an earlier year. Records without digest are always kept. Every skipped record is listed as an alias
+    of the kept record, whose links it shares in Stages 3 and 4.
+
+    :param records: Records to filter.
+    :param seen: Kept (timestamp, url) per digest seen before, updated with the kept records.
+    :param aliases: List to append the skipped records to, as (timestamp, url, digest, kept timestamp, kept url).
+    :return: Records that have been kept.
+    """
+    mask = []
+    for timestamp, url, digest in zip(records.timestamps, records.urls, records.digests):
+        kept = seen.get(digest) if digest else None
+        if kept is None:
+            if digest:
+                seen[digest] = (timestamp, url)
+            mask.append(True)
+        else:
+            aliases.append((timestamp, url, digest) + kept)
+            mask.append(False)
+    return CDXRecords(array('q', compress(records.timestamps, mask)), list(compress(records.urls, mask)),
+                      list(compress(records.digests, mask)))
+
+
+CDX_URL = "http://web.archive.org/cdx/search/cdx"
+FINISHED = "finished"
+
+
+class CDXProfile:
+    def __init__(self, fields: List[str], filters: List[str] = (), collapse: List[str] = (), from_: str = None,
+                 to: str = None, skip_duplicate_digests: bool = False):
+        """
+        Query of the CDX Api. Filtering and collapsing on the server shrinks both the CDX transfer and the amount of
+        pages fetched in Stage 2.
+
+        :param fields: Fields to return, in order. Must contain urlkey and timestamp, and may contain digest.
+        :param filters: Filters in the form [!]field:regex, all of which a capture must match.
+        :param collapse: Fields, or field prefixes in the form field:length, of which adjacent captures with equal
+        values are collapsed to the first.
+        :param from_: Lower bound of the timestamps, i.e. 2012.
+        :param to: Upper bound of the timestamps, i.e. 2019.
+        :param skip_duplicate_digests: Whether to skip captures with the same digest as an earlier capture of the
+        domain, listing them as aliases of that capture.
+        """
+        self.fields = list(fields)
+        self.filters = list(filters)
+        self.collapse = list(collapse)
+        self.from_ = from_
+        self.to = to
+        self.skip_duplicate_digests = skip_duplicate_digests
+
+    def payload(self, domain: str, limit: int) -> List[Tuple[str, str]]:
+        """
+        Parameters of a request, as a list as filter and collapse may be repeated.
+
+        :param domain: Domain of the organisation.
+        :param limit: Maximum amount of records per request.
+        :return: Parameters of the request.
+        """
+        payload = [
+            ('url', domain),
+            ('matchType', 'prefix'),
+            ('fl', ','.join(self.fields)),
+            # ('showDupeCount', 'true'),
+            # ('showSkipCount', 'true'),
+            ('limit', str(limit)),
+            ('showResumeKey', 'true'),
+        ]
+        payload += [('filter', value) for value in self.filters]
+        payload += [('collapse', value) for value in self.collapse]
+        if self.from_:
+            payload.append(('from', self.from_))
+        if self.to:
+            payload.append(('to', self.to))
+        return payload
+
+
+CDX_PROFILES = {
+    # Every capture per url and year, filtered on extension only
+    "legacy": CDXProfile(["urlkey", "timestamp"], collapse=["timestamp:4"], from_="2012"),
+    # Successfully captured html pages per url and year, skipping captures that are identical to an earlier capture of
+    # the same or another url. Skipped captures are listed as aliases of the capture that is fetched
+    "html": CDXProfile(["urlkey", "timestamp", "digest"], filters=["mimetype:text/html", "statuscode:200"],
+                       collapse=["timestamp:4"], from_="2012", skip_duplicate_digests=True),
+}
+
+
+class CDXPageParser:
+    def __init__(self, domain: str, records: CDXRecords, fields: List[str]):
+        """
+        Parses a page of CDX records in the plain text output format line by line, while it is streamed. The records
+        are followed by an empty line and the resume key if there are more pages.
+
+        :param domain: Domain of the organisation, which replaces its url key in the urls.
+        :param records: Records to append the records of the page to.
+        :param fields: Fields of the records, in order.
+        """
+        self.domain = domain
+        self.records = records
+        self.resume_key = FINISHED
+        self._urlkey_index = fields.index("urlkey")
+        self._timestamp_index = fields.index("timestamp")
+        self._digest_index = fields.index("digest") if "digest" in fields else None
+
+        # Replace org.example) with example.org
+        domain_split = domain.split('.')
+        domain_split.reverse()
+        self._domain_key = ",".join(domain_split) + ')'
+        self._resume_key_follows = False
+        self._previous = None
+
+    def feed(self, line: str) -> None:
+        if not line:
+            self._resume_key_follows = True
+        elif self._resume_key_follows:
+            self.resume_key = line.strip()
+        else:
+            values = line.split(' ')
+            link = values[self._urlkey_index]
+            record = (int(values[self._timestamp_index]), link.replace(self._domain_key, self.domain))
+            # Records are sorted by url_key and timestamp, thus duplicates are always adjacent
+            if record != self._previous:
+                digest = values[self._digest_index] if self._digest_index is not None else ''
+                self.records.append(*record, digest)
+                self._previous = record
+
 
 class UrlFetcher:
-    def __init__(self, domain: str, output_folder: Path = Path("./output/url_list/")):
+    def __init__(self, domain: str, output_folder: Path = Path("./output/url_list/"), page_limit: int = 10000,
+                 timeout: float = 60, profile: CDXProfile = CDX_PROFILES["legacy"]):
+        """
+        Fetches the CDX records of a domain, one page of at most page_limit records at a time. Every page is written
+        as a part of the records checkpoint, so an interrupted fetch resumes at the last completed page.
+
+        :param domain: Domain of the organisation.
+        :param output_folder: Folder to write the checkpoints and csv to.
+        :param page_limit: Maximum amount of records per request.
+        :param timeout: Timeout in seconds of a single request.
+        :param profile: Query of the CDX Api. A resumed fetch keeps the profile it was started with.
+        """
         self.domain = domain
+        self.page_limit = page_limit
+        self.timeout = timeout
+        self.profile = profile
         output_folder.mkdir(parents=True, exist_ok=True)
         output_file = urllib.parse.quote(self.domain.replace('/', '_'))
         self.output_path = output_folder / Path(output_file)
-
-    def __write(self, header: str, urls: Set[CDXRecord], resume_key: str):
-        data = {'domain': self.domain, 'header': header, 'resume_key': resume_key,
-                'urls': [page.__dict__ for page in urls]}
-
-        # Output path exists --> Append mode
-        with open(self.output_path, "w") as file:
-            json.dump(data, file, indent=2)
-
-    def __read(self) -> Tuple[str, Set[CDXRecord], str]:
+        self.records_folder = Path(str(self.output_path) + '.records')
+        self.csv_path = Path(str(self.output_path) + '.csv')
+        self.aliases_path = Path(str(self.output_path) + ALIASES_SUFFIX)
+
+        # Progress of fetching pages
+        self.resume_key = None
+        self.parts = 0
+        self.fetched_records = 0
+
+        # Amount of records per extension, and of records skipped for their digest, of the last call to get_html_urls
+        self.kept_extensions = Counter()
+        self.dropped_extensions = Counter()
+        self.duplicate_digests = 0
+        self.aliases = []
+
+    def __write(self, profile: CDXProfile, resume_key: str, parts: int):
+        data = {'domain': self.domain, 'header': profile.fields, 'profile': vars(profile), 'resume_key': resume_key,
+                'parts': parts}
+
+        # Replace the checkpoint atomically, it must never count parts that have not been written
+        temp_path = Path(str(self.output_path) + '.tmp')
+        with open(temp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(str(temp_path), str(self.output_path))
+
+    def __read(self) -> Tuple[CDXProfile, str, int]:
         if not self.output_path.exists():
             raise FileNotFoundError(f"File {self.output_path} does not exist.")
 
-        # Output path exists --> Append mode
         with open(self.output_path, "r") as json_file:
             saved_data = json.load(json_file)
 
-            if self.domain != saved_data['domain']:
-                raise ValueError("Saved domain is different from current domain")
+        if self.domain != saved_data['domain']:
+            raise ValueError("Saved domain is different from current domain")
+
+        if 'parts' not in saved_data:
+            # Checkpoint of an older version, which holds all records, convert its records to the first part
+            records = CDXRecords()
+            for p in saved_data['urls']:
+                records.append(int(p['timestamp']), p['url'])
+            self.records_folder.mkdir(exist_ok=True)
+            write_part(self.__part_path(0), records)
+            self.__write(CDX_PROFILES["legacy"], saved_data['resume_key'], 1)
+            return CDX_PROFILES["legacy"], saved_data['resume_key'], 1
 
-            return saved_data['header'], \
-                   set(CDXRecord(p['timestamp'], p['url']) for p in saved_data['urls']), \
-                   saved_data['resume_key']
+        profile = CDXProfile(**saved_data['profile']) if 'profile' in saved_data else CDX_PROFILES["legacy"]
+        return profile, saved_data['resume_key'], saved_data['parts']
 
     def __checkpoint_available(self) -> bool:
         return self.output_path.exists()
 
-    def __get_url_list(self):
-        payload = {
-            'url': self.domain,
-            'matchType': 'prefix',
-            'fl': 'urlkey,timestamp',
-            'collapse': 'timestamp:4',
-            'from': '2012',
-            # 'showDupeCount': 'true',
-            # 'showSkipCount': 'true',
-            # 'limit': '4',
-            'output': 'json',
-            'showResumeKey': 'true',
-        }
-        filtered_urls = set()
-
-        if self.__checkpoint_available():
-            prev_header, prev_urls, prev_resume_key = self.__read()
+    def __part_path(self, index: int) -> Path:
+        return self.records_folder / f"part-{index:05d}"
 
-            # Fetching has been completed
-            if prev_resume_key == "finished":
-                return prev_urls
+    def __part_paths(self) -> List[Path]:
+        return sorted(path for path in self.records_folder.glob("part-*") if path.suffix != '.tmp')
 
-            # Fetching can be resumed
-            filtered_urls = prev_urls
-            payload["resumeKey"] = prev_resume_key
+    @property
+    def finished(self) -> bool:
+        return self.resume_key == FINISHED
 
-        # Get response from url
-        response = requests.get('http://web.archive.org/cdx/search/cdx', params=payload)
-        response_list = response.json()
-
-        # Extraction
-        if not response_list:
+    def _resume(self) -> None:
+        """
+        Continue at the last page in the checkpoint, dropping the parts that were written after it.
+        """
+        if self.__checkpoint_available():
+            profile, self.resume_key, self.parts = self.__read()
+            if vars(profile) != vars(self.profile):
+                logging.getLogger().warning(f"{self.domain}: continuing with the CDX profile of the checkpoint")
+                self.profile = profile
+
+        if not self.finished:
+            self.records_folder.mkdir(exist_ok=True)
+            for path in self.__part_paths()[self.parts:]:
+                path.unlink()
+
+    def _next_page(self) -> Tuple[List[Tuple[str, str]], CDXPageParser]:
+        """
+        Prepare the request of the next page.
+
+        :return: Parameters of the request and the parser of its response.
+        """
+        payload = self.profile.payload(self.domain, self.page_limit)
+        if self.resume_key is not None:
+            # The resume key is returned url encoded, and encoded again as parameter
+            payload.append(('resumeKey', urllib.parse.unquote_plus(self.resume_key)))
+        return payload, CDXPageParser(self.domain, CDXRecords(), self.profile.fields)
+
+    def _complete_page(self, parser: CDXPageParser) -> None:
+        """
+        Write a fetched page as the next part of the records checkpoint.
+
+        :param parser: Parser the page has been fed to.
+        """
+        write_part(self.__part_path(self.parts), parser.records)
+        self.parts += 1
+        self.fetched_records += len(parser.records)
+        self.resume_key = parser.resume_key
+        self.__write(self.profile, self.resume_key, self.parts)
+
+        if self.finished and self.parts == 1 and not parser.records:
             print(f"Nope: {self.domain}")
-            return
-
-        header = response_list[0]
-        if not response_list[-2]:
-            resume_key = response_list[-1][0]
-            urls = response_list[1:-2]  # The before last one is always empty -> -2
-        else:
-            resume_key = "finished"
-            urls = response_list[1:]
 
-        # Replace org.example) with example.org
-        domain_split = self.domain.split('.')
-        domain_split.reverse()
-        domain_key = ",".join(domain_split) + ')'
+    def __fetch_pages(self):
+        """
+        Fetch all remaining pages of CDX records into the records checkpoint.
+        """
+        self._resume()
+
+        session = requests.Session()
+        while not self.finished:
+            payload, parser = self._next_page()
+            with session.get(CDX_URL, params=payload, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    parser.feed(line)
+            self._complete_page(parser)
+
+    def get_html_urls(self) -> Iterator[CDXRecord]:
+        self.__fetch_pages()
+
+        self.kept_extensions = Counter()
+        self.dropped_extensions = Counter()
+        self.duplicate_digests = 0
+        self.aliases = []
+        seen_digests = {}
+        for path in self.__part_paths():
+            records = filter_html_urls(read_part(path), self.kept_extensions, self.dropped_extensions)
+            if self.profile.skip_duplicate_digests:
+                count = len(records)
+                records = skip_duplicate_digests(records, seen_digests, self.aliases)
+                self.duplicate_digests += count - len(records)
+            yield from records
+
+    def csv_up_to_date(self) -> bool:
+        """
+        Whether the csv has been written after the last page was fetched.
+        """
+        return self.finished and self.csv_path.exists() and \
+            self.csv_path.stat().st_mtime >= self.output_path.stat().st_mtime
+
+    def write_to_csv(self, records: Iterable[CDXRecord]):
+        """
+        Write the records to the csv. If duplicate captures were skipped while the records were read, they are written
+        to the aliases csv afterwards, formatted as (timestamp, url, digest, fetched timestamp, fetched url).
+
+        :param records: Records, i.e. of get_html_urls.
+        """
+        with open(self.csv_path, mode='w') as csv_file:
+            csv_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        for link, timestamp in urls:
-            filtered_urls.add(CDXRecord(timestamp, link.replace(domain_key, self.domain)))
+            if "digest" in self.profile.fields:
+                csv_writer.writerow(["timestamp", "url", "digest"])
+                for record in records:
+                    csv_writer.writerow([record.timestamp, record.url, record.digest])
+            else:
+                csv_writer.writerow(["timestamp", "url"])
+                for record in records:
+                    csv_writer.writerow([record.timestamp, record.url])
+
+        if self.profile.skip_duplicate_digests:
+            temp_path = self.aliases_path.with_suffix('.tmp')
+            with open(temp_path, mode='w', newline='') as csv_file:
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(["timestamp", "url", "digest", "fetched_timestamp", "fetched_url"])
+                csv_writer.writerows(self.aliases)
+            os.replace(str(temp_path), str(self.aliases_path))
+
+
+class CDXCrawler:
+    def __init__(self, fetchers: List[UrlFetcher], limit_rate: float = 2.0, max_connections: int = 4,
+                 max_attempts: int = 5, base_delay: float = 2.0, rate_controller: str = "aimd"):
+        """
+        Fetches the CDX records of many domains in a single event loop. All domains share a token bucket and a
+        bounded pool of keep-alive connections to the CDX Api, and take turns in requesting their next page.
+
+        :param fetchers: Fetchers of the domains.
+        :param limit_rate: Maximum amount of requests per second.
+        :param max_connections: Maximum amount of concurrent requests.
+        :param max_attempts: Maximum amount of attempts per page before a domain is given up.
+        :param base_delay: Amount of seconds to wait before the first retry, doubled on every retry.
+        :param rate_controller: Name of the rate controller in RATE_CONTROLLERS that adapts the rate on throttling.
+        """
+        self.fetchers = fetchers
+        self._bucket = TokenBucket(limit_rate, 1)
+        self._controller = RATE_CONTROLLERS[rate_controller](self._bucket, limit_rate)
+        self._max_connections = max_connections
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._finished = 0
+
+    def crawl(self) -> Dict[str, Exception]:
+        """
+        Fetch the remaining pages of all domains, and write the html urls of each completed domain to its csv.
+
+        :return: Exception per domain that could not be completed.
+        """
+        if aiohttp is None:
+            raise ImportError("The CDX crawler requires aiohttp, install it using 'pip install aiohttp'")
+
+        return asyncio.run(self.__crawl())
+
+    async def __crawl(self) -> Dict[str, Exception]:
+        # Semaphore waiters are woken in order, thus domains take turns
+        slots = asyncio.Semaphore(self._max_connections)
+        connector = aiohttp.TCPConnector(limit=self._max_connections, keepalive_timeout=30, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*(self.__crawl_domain(session, slots, fetcher)
+                                             for fetcher in self.fetchers), return_exceptions=True)
+        return {fetcher.domain: result for fetcher, result in zip(self.fetchers, results)
+                if isinstance(result, Exception)}
+
+    async def __crawl_domain(self, session, slots: asyncio.Semaphore, fetcher: UrlFetcher) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, fetcher._resume)
+            while not fetcher.finished:
+                parser = await self.__fetch_page(session, slots, fetcher)
+                # Writing a part is blocking file IO
+                await loop.run_in_executor(None, fetcher._complete_page, parser)
+                logging.getLogger().info(f"{fetcher.domain}: fetched page {fetcher.parts}, "
+                                         f"{fetcher.fetched_records} records in this run")
+
+            if not fetcher.csv_up_to_date():
+                await loop.run_in_executor(None, lambda: fetcher.write_to_csv(fetcher.get_html_urls()))
+                dropped = ", ".join(f"{extension or 'none'}: {count}"
+                                    for extension, count in fetcher.dropped_extensions.most_common(5))
+                logging.getLogger().info(f"{fetcher.domain}: kept {sum(fetcher.kept_extensions.values())} html "
+                                         f"urls, dropped {sum(fetcher.dropped_extensions.values())} ({dropped}), "
+                                         f"skipped {fetcher.duplicate_digests} duplicate captures as aliases")
+        except Exception as e:
+            logging.getLogger().error(f"{fetcher.domain}: giving up after {fetcher.parts} pages")
+            logging.getLogger().exception(e)
+            raise
+        finally:
+            self._finished += 1
+            logging.getLogger().info(f"Finished {fetcher.domain} ({self._finished}/{len(self.fetchers)} domains)")
+
+    async def __fetch_page(self, session, slots: asyncio.Semaphore, fetcher: UrlFetcher) -> CDXPageParser:
+        """
+        Stream the next page of CDX records of a domain into a parser, retrying throttled and failed requests with
+        exponential backoff.
+
+        :param session: aiohttp session holding the keep-alive connections.
+        :param slots: Semaphore bounding the amount of concurrent requests.
+        :param fetcher: Fetcher of the domain.
+        :return: Parser the page has been fed to.
+        """
+        timeout = aiohttp.ClientTimeout(total=fetcher.timeout)
+        for attempt in range(1, self._max_attempts + 1):
+            payload, parser = fetcher._next_page()
+            try:
+                async with slots:
+                    await self._bucket.acquire_async()
+                    async with session.get(CDX_URL, params=payload, timeout=timeout) as response:
+                        if response.status == 429 or response.status >= 500:
+                            self._controller.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+                            raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                              status=response.status, message=response.reason)
+                        response.raise_for_status()
+                        async for line in response.content:
+                            parser.feed(line.decode("utf-8").rstrip("\r\n"))
+                self._controller.on_success()
+                return parser
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retry = not isinstance(e, aiohttp.ClientResponseError) or e.status == 429 or e.status >= 500
+                if not retry or attempt == self._max_attempts:
+                    raise
+                if not isinstance(e, aiohttp.ClientResponseError):
+                    self._controller.on_throttle()
+                delay = self._base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logging.getLogger().warning(f"{fetcher.domain}: {type(e).__name__} on page {fetcher.parts + 1}, "
+                                            f"retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+
+
+def stable_hash(value: str) -> int:
+    """
+    Hash that is equal in every process and run, unlike hash().
+    """
+    return zlib.crc32(value.encode('utf-8'))
+
+
+class ShardWriter:
+    def __init__(self, folder: Path, shards: int, key: str = "url", weights: Dict[str, float] = None):
+        """
+        Distributes the html urls of all organisations over shards of balanced fetch cost, named data0.csv to
+        data{shards - 1}.csv, which are the input of page_fetcher on every server of the fleet.
+
+        :param folder: Folder to write the shards to.
+        :param shards: Amount of shards.
+        :param key: Either url, to spread every organisation over all shards by a stable hash of the url, or domain, to
+        keep every organisation in a single shard.
+        :param weights: Estimated fetch cost of a record per domain, i.e. 2 for domains with slow pages. Defaults to 1.
+        """
+        if key not in ("url", "domain"):
+            raise ValueError(f"Cannot shard by {key}")
+        self.folder = folder
+        self.shards = shards
+        self.key = key
+        self.weights = weights or {}
+
+    def write(self, fetchers: List[UrlFetcher]) -> List[float]:
+        """
+        Write the csv files of the fetchers to the shards, without their headers.
+
+        :param fetchers: Fetchers that have written their csv files.
+        :return: Estimated fetch cost per shard.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        paths = [self.folder / f"data{shard}.csv" for shard in range(self.shards)]
+        files = [open(path.with_suffix('.tmp'), 'w', newline='') for path in paths]
+        writers = [csv.writer(file) for file in files]
+        costs = [0.0] * self.shards
+        try:
+            if self.key == "url":
+                for fetcher in sorted(fetchers, key=lambda f: f.domain):
+                    weight = self.weights.get(fetcher.domain, 1.0)
+                    for row in self.__read_rows(fetcher):
+                        shard = stable_hash(row[1]) % self.shards
+                        writers[shard].writerow(row)
+                        costs[shard] += weight
+            else:
+                # Largest organisations first, each to the shard with the lowest cost so far
+                domain_costs = {fetcher.domain: sum(1 for _ in self.__read_rows(fetcher)) *
+                                self.weights.get(fetcher.domain, 1.0) for fetcher in fetchers}
+                for fetcher in sorted(fetchers, key=lambda f: (-domain_costs[f.domain], f.domain)):
+                    shard = min(range(self.shards), key=lambda i: (costs[i], i))
+                    writers[shard].writerows(self.__read_rows(fetcher))
+                    costs[shard] += domain_costs[fetcher.domain]
+        finally:
+            for file in files:
+                file.close()
+
+        for path in paths:
+            os.replace(str(path.with_suffix('.tmp')), str(path))
+        return costs
 
-        # Write to file
-        self.__write(header, filtered_urls, resume_key)
+    @staticmethod
+    def __read_rows(fetcher: UrlFetcher) -> Iterator[List[str]]:
+        with open(fetcher.csv_path, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Skip the header
+            yield from reader
 
-        return filtered_urls
 
-    @staticmethod
-    def __filter_html_urls(records: Set[CDXRecord]) -> Set[CDXRecord]:
-        result = set()
-        for r in records:
-            url = urlparse(r.url).path
-            included_extensions = ['.ae', '.aero', '.br', '.by', '.ca', '.cern', '.ch', '.com', '.cr', '.dk', '.es',
-                                   '.et', '.eu', '.fi', '.fj', '.info', '.int', '.international', '.is', '.jm', '.mk',
-                                   '.my', '.ne', '.net', '.org', '.pl', '.qa', '.ru', '.se',
-
-                                   '.html', '.htm', '.php']
-            if any([url[-5:].endswith(ext) for ext in included_extensions]) or '.' not in url[-5:]:
-                result.add(r)
-
-        return result
-
-    def get_html_urls(self):
-        links = self.__get_url_list()
-        return self.__filter_html_urls(links)
-
-    def write_to_csv(self, records: Set[CDXRecord]):
-        with open(str(self.output_path) + '.csv', mode='w') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+def read_weights(path: Path) -> Dict[str, float]:
+    """
+    Read the estimated fetch cost per domain.
 
-            csv_writer.writerow(["timestamp", "url"])
-            for record in records:
-                csv_writer.writerow([record.timestamp, record.url])
+    :param path: Path to a csv formatted as (domain, weight).
+    :return: Weight per domain.
+    """
+    with open(path, 'r', newline='') as file:
+        return {row[0]: float(row[1]) for row in csv.reader(file) if row}
 
 
 def main():
-    output_folder = Path("output")
-    output_folder.mkdir(parents=True, exist_ok=True)
+    parser = argparse.ArgumentParser(description='Fetch the CDX records of organisations from the Internet Archive.')
+    parser.add_argument("--organisations", "-o", help="Path to the list of organisation domains",
+                        default="organisations.txt")
+    parser.add_argument("--output", help="Folder to write the checkpoints and csv files to",
+                        default="./output/url_list/")
+    parser.add_argument("--limit_rate", help="Maximum amount of requests per second", type=float, default=2.0)
+    parser.add_argument("--connections", help="Maximum amount of concurrent requests", type=int, default=4)
+    parser.add_argument("--page_limit", help="Maximum amount of records per request", type=int, default=10000)
+    parser.add_argument("--max_attempts", help="Maximum amount of attempts per page", type=int, default=5)
+    parser.add_argument("--rate_controller", help="Rate controller that adapts the rate on throttling",
+                        choices=sorted(RATE_CONTROLLERS), default="aimd")
+    parser.add_argument("--profile", help="Query of the CDX Api", choices=sorted(CDX_PROFILES), default="legacy")
+    parser.add_argument("--from_timestamp", help="Lower bound of the timestamps, overriding the profile",
+                        default=None)
+    parser.add_argument("--to_timestamp", help="Upper bound of the timestamps, overriding the profile", default=None)
+    parser.add_argument("--shards", help="Amount of data[n].csv files to distribute the records over, one per "
+                                         "server. Disabled by default", type=int, default=0)
+    parser.add_argument("--shard_by", help="Spread every organisation over all shards, or keep it in one shard",
+                        choices=["url", "domain"], default="url")
+    parser.add_argument("--shard_weights", help="Path to a csv formatted as (domain, weight) of the estimated fetch "
+                                                "cost of a record per domain", default=None)
+    parser.add_argument("--shards_folder", help="Folder to write the shards to", default="./output/shards/")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s', datefmt='%H:%M:%S')
     """
     CDX returns record
     Record contains url, timestamp
     Url contains links
     """
-    domains = [line.strip() for line in open("organisations.txt", 'r')]
-
-    def csv_all(domain):
-        try:
-            uf = UrlFetcher(domain)
-            uf.write_to_csv(uf.get_html_urls())
-        except Exception as e:
-            print(domain)
-            print(e)
-
-    Parallel(n_jobs=-1)(delayed(csv_all)(domain) for domain in domains)
+    domains = [line.strip() for line in open(args.organisations, 'r') if line.strip()]
+    profile = CDXProfile(**vars(CDX_PROFILES[args.profile]))
+    profile.from_ = args.from_timestamp or profile.from_
+    profile.to = args.to_timestamp or profile.to
+    fetchers = [UrlFetcher(domain, Path(args.output), args.page_limit, profile=profile) for domain in domains]
+
+    crawler = CDXCrawler(fetchers, args.limit_rate, args.connections, args.max_attempts,
+                         rate_controller=args.rate_controller)
+    failed = crawler.crawl()
+    for domain, e in failed.items():
+        print(domain)
+        print(e)
+
+    if args.shards > 0:
+        weights = read_weights(Path(args.shard_weights)) if args.shard_weights else None
+        writer = ShardWriter(Path(args.shards_folder), args.shards, args.shard_by, weights)
+        costs = writer.write([fetcher for fetcher in fetchers if fetcher.domain not in failed])
+        logging.getLogger().info(f"Wrote {args.shards} shards with an estimated cost between {min(costs):.0f} and "
+                                 f"{max(costs):.0f}")
 
 
 if __name__ == "__main__":
@@ -1,124 +1,341 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
-from urllib.parse import urlparse
+from typing import Iterable, Iterator, Optional
 import pandas as pd
 import argparse
-import re
+import logging
+import os
+import shutil
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:  # Only required for Arrow-backed string columns and Parquet output
+    pyarrow = None
+
+WAYBACK_PREFIX = "http://web.archive.org"
+OUTPUT_COLUMNS = ["source", "timestamp", "src_link", "target", "full_link"]
+
+# Parquet output: edges/source=[domain]/year=[year]/*.parquet and edge_weights/source=[domain]/weights.parquet,
+# consolidated into edge_weights.parquet
+EDGES_FOLDER = "edges"
+EDGE_WEIGHTS_FOLDER = "edge_weights"
+EDGE_WEIGHTS_FILE = "edge_weights.parquet"
+
+if pyarrow is not None:
+    # The source organisation is the partition of the edges, and not stored in their files
+    EDGE_SCHEMA = pyarrow.schema([
+        ("timestamp", pyarrow.int64()),
+        ("src_link", pyarrow.string()),
+        ("target", pyarrow.string()),
+        ("full_link", pyarrow.string()),
+        ("year", pyarrow.int16()),
+    ])
+    WEIGHT_SCHEMA = pyarrow.schema([
+        ("target", pyarrow.string()),
+        ("year", pyarrow.int16()),
+        ("count", pyarrow.int64()),
+    ])
+
+
+class TargetIndex:
+    # Key of the target ending at a node, labels are never empty
+    TARGET = ""
+
+    def __init__(self, targets: Iterable[str]):
+        """
+        Reverse-domain trie of the target organisations, i.e. org -> un -> www for www.un.org. A host is matched by
+        walking its labels from the top-level domain down, so matching costs the amount of labels of the host instead
+        of the amount of targets.
+        :param targets: Domains of the target organisations.
+        """
+        root = {}
+        for target in targets:
+            node = root
+            for label in reversed(target.lower().strip('.').split('.')):
+                node = node.setdefault(label, {})
+            node[self.TARGET] = target
+        self._root = root
+
+    def match(self, host: str) -> Optional[str]:
+        """
+        Find the most specific target a host belongs to, i.e. ecb.europa.eu rather than europa.eu for www.ecb.europa.eu.
+        Hosts only match whole labels, so unwto.org does not belong to wto.org.
+        :param host: Host name.
+        :return: Domain of the target, or None if the host belongs to none of the targets.
+        """
+        node = self._root
+        match = None
+        for label in reversed(host.lower().strip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get(self.TARGET, match)
+        return match
+
+    @classmethod
+    def from_file(cls, targets_path: Path) -> "TargetIndex":
+        """
+        Load the targets, once per process. The index is shared by all organisations and must not be modified.
+        :param targets_path: Path to the list of target domains, one per line.
+        :return: Index of the targets.
+        """
+        return _load_targets(str(Path(targets_path).resolve()))
+
+
+@lru_cache(maxsize=None)
+def _load_targets(targets_path: str) -> TargetIndex:
+    with open(targets_path, 'r') as file:
+        return TargetIndex(line.strip() for line in file if line.strip())
+
+
+def read_lines(source_path: Path, chunk_size: int) -> Iterator[pd.Series]:
+    """
+    Read the lines of a file in chunks. With pyarrow, lines are read straight into Arrow strings, on which pandas runs
+    its string operations in native code.
+    :param source_path: Path to the file.
+    :param chunk_size: Approximate size in bytes of a chunk.
+    :return: Generator of chunks of lines.
+    """
+    if pyarrow is None:
+        with open(str(source_path), 'r') as file:
+            lines = file.readlines(chunk_size)
+            while lines:
+                yield pd.Series(lines, dtype=object)
+                lines = file.readlines(chunk_size)
+        return
+
+    # Organisations without pages have an empty file, which pyarrow refuses to open
+    if source_path.stat().st_size == 0:
+        return
+
+    # Every line is a single column, as the delimiter does not occur in urls and quotes are not special
+    reader = pyarrow.csv.open_csv(
+        str(source_path),
+        read_options=pyarrow.csv.ReadOptions(column_names=["line"], block_size=chunk_size),
+        parse_options=pyarrow.csv.ParseOptions(delimiter='\x1f', quote_char=False, escape_char=False,
+                                               invalid_row_handler=lambda row: "skip"),
+        convert_options=pyarrow.csv.ConvertOptions(column_types={"line": pyarrow.string()}))
+    for batch in reader:
+        yield pd.Series(pd.arrays.ArrowStringArray(batch.column(0)))
 
 
 class ExtLinkLister():
-    def __init__(self, source: str, targets_path: Path):
+    def __init__(self, source: str, targets_path: Path, targets: TargetIndex = None,
+                 chunk_size: int = 64 * 1024 * 1024):
         """
         Retrieves external hyperlinks and stores these in csv file
         ready to be used in network analyses
         :param source:
+        :param targets_path: Path to the list of target domains.
+        :param targets: Index of the targets, loaded from targets_path if not given.
+        :param chunk_size: Size in bytes of the chunks of links processed at once.
         """
         self.source = source
         self.targets_path = targets_path
+        self.targets = targets or TargetIndex.from_file(targets_path)
+        self.chunk_size = chunk_size
         self.no_link = []
 
-    def list_ext_links(self, source_path: Path, output_path: Path):
+    def iter_ext_links(self, source_path: Path) -> Iterator[pd.DataFrame]:
         """
-        Retrieves external hyperlinks and stores these in csv file
-        ready to be used in network analyses.
+        Retrieves external hyperlinks in chunks.
         :param source_path: Path to input file
-        :param output_path: Path to output file
+        :return: Generator of frames with the OUTPUT_COLUMNS
         """
         if not source_path.exists():
             raise IOError("Given csv file does not exists")
 
-        with open(str(source_path), 'r') as file:
-            urls = [line.rstrip() for line in file]
-        src_links, ext_links = self.__filter_links(urls)
-        my_dict = self.__create_list(src_links, ext_links)
-
-        self.__write_csv(my_dict, output_path)
-
-    def __filter_links(self, urls: list):
-        """
-        Split source url into requested output parts
-        :param urls: List with all complete IA urls
-        :return: subset of urls split into source and destination url
-        """
-        prefix = "http://web.archive.org"
-        domain = self.source[:-4]
-        mail = "mailto"
-
-        with open(str(self.targets_path), 'r') as file:
-            targets = [line.rstrip() for line in file]
-        l_index = []
-        src_link = []
-        ext_link = []
-
-        for i in range(0, len(urls)):
-            src = ([urls[i].split('∞', 1)[0]])
-            ext = ([urls[i].split('∞', 1)[1]])
-            if mail not in ext[0]:
-                if prefix in ext[0]:
-                    if domain not in ext[0]:
-                        if any(target in ext[0] for target in targets):
-                            src_link.append(src)
-                            ext_link.append(ext)
-        return src_link, ext_link
-
-    def __create_list(self, org_src_links: list, org_ext_links: list):
-        """
-        Split source url into requested output parts
-        :param org_src_links: List with urls of source website.
-        :param org_ext_links: List with urls to external website.
-        :return: List with source and destination organizations and timestamps
-        """
-        data = []
-        for i in range(0, len(org_ext_links)):
-            src_link = self.__split_source(org_src_links[i])
-            ext_link = self.__split_url(org_ext_links[i])
-            data.append([src_link[0], src_link[1], src_link[2], ext_link[0], ext_link[1]])
-        return data
-
-    def __split_source(self, url: str):
-        """
-        Split source url into requested output parts
-        :param url: Url to external website.
-        :return: Url parts
+        for lines in read_lines(source_path, self.chunk_size):
+            yield self.__filter_links(lines.str.rstrip())
+
+    def list_ext_links(self, source_path: Path, output_path: Path):
         """
+        Retrieves external hyperlinks and stores these in csv file
+        ready to be used in network analyses. The links are processed in chunks of columns, and the output file is
+        only replaced once all links have been written.
+        :param source_path: Path to input file
+        :param output_path: Path to output file
+        """
+        offset = 0
+        tmp_path = output_path.with_name(output_path.name + ".tmp")
         try:
-            p = url[0].split('_')
-            q = p[0]
-            return [q.split('/')[0], q.split('/')[1], '/'.join(p[1:])]    # [q, p[1:-1]]??
-        except Exception:
-            print(url)
-            self.no_link.append(url)
+            with open(str(tmp_path), 'w', newline='') as output:
+                pd.DataFrame(columns=OUTPUT_COLUMNS).rename_axis("index").to_csv(output)
+                for links in self.iter_ext_links(source_path):
+                    links.index = pd.RangeIndex(offset, offset + len(links))
+                    links.to_csv(output, header=False)
+                    offset += len(links)
+            os.replace(str(tmp_path), str(output_path))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
 
-    def __split_url(self, url: str):
+    def write_edges(self, source_path: Path, edges_folder: Path, weights_path: Path):
         """
-        Split destination url into requested output parts
-        :param url: Url to external website.
-        :return: Url parts
+        Retrieves external hyperlinks and stores these as the partition of the organisation in the consolidated edge
+        dataset, edges/source=[domain]/year=[year]/*.parquet, replacing the partition written by a previous run.
+        The amount of links per target and year is stored in weights_path.
+        :param source_path: Path to input file
+        :param edges_folder: Folder of the edge dataset
+        :param weights_path: Path to the edge weights of the organisation
         """
-        try:
-            p = urlparse(url[0])
-            ia_link = ''.join([p.path, p.query])
-            full_link = re.split(r'/[a-z]{3,5}://', ia_link)[1]
-            with open(str(self.targets_path), 'r') as file:
-                targets = [line.rstrip() for line in file]
+        if pyarrow is None:
+            raise ImportError("Parquet output requires pyarrow, install it using 'pip install pyarrow'")
 
-            for target in targets:
-                if target in full_link:
-                    t_org = target
-            return [t_org, full_link]
-        except Exception:
-            print(url)
-            self.no_link.append(url)
+        partition = f"source={self.source}"
+        # Dataset readers skip folders starting with a dot
+        tmp_folder = edges_folder / f".{partition}.tmp"
+        old_folder = edges_folder / f".{partition}.old"
+        shutil.rmtree(str(tmp_folder), ignore_errors=True)
+        tmp_folder.mkdir(parents=True)
 
-    def __write_csv(self, data: list, output_path: Path):
+        weights = []
+        for chunk, links in enumerate(self.iter_ext_links(source_path)):
+            edges = to_edges(links)
+            pyarrow.dataset.write_dataset(
+                to_table(edges, EDGE_SCHEMA), str(tmp_folder),
+                format="parquet", partitioning=pyarrow.dataset.partitioning(
+                    pyarrow.schema([EDGE_SCHEMA.field("year")]), flavor="hive"),
+                basename_template=f"part-{chunk}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore",
+                file_options=pyarrow.dataset.ParquetFileFormat().make_write_options(compression="zstd"))
+            weights.append(edges.groupby(["target", "year"]).size())
+
+        shutil.rmtree(str(old_folder), ignore_errors=True)
+        if (edges_folder / partition).exists():
+            os.replace(str(edges_folder / partition), str(old_folder))
+        os.replace(str(tmp_folder), str(edges_folder / partition))
+        shutil.rmtree(str(old_folder), ignore_errors=True)
+
+        # The weights are written last, as their modification time marks the organisation as up to date
+        if weights:
+            weights = pd.concat(weights).groupby(level=[0, 1]).sum().rename("count").reset_index()
+        else:
+            weights = pd.DataFrame({"target": [], "year": [], "count": []})
+        weights_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = weights_path.with_name(weights_path.name + ".tmp")
+        pyarrow.parquet.write_table(to_table(weights, WEIGHT_SCHEMA), str(tmp_path))
+        os.replace(str(tmp_path), str(weights_path))
+
+    def __filter_links(self, lines: pd.Series) -> pd.DataFrame:
         """
-        Write data to file.
-        :param output_path: Path to output file.
-        :param data: List to write.
+        Filter the links to target organisations, and split them into the output columns
+        :param lines: Lines formatted as source∞destination
+        :return: Frame with the OUTPUT_COLUMNS of the links to target organisations
         """
-        df = pd.DataFrame(data)
-        df.index.name = "index"
-        df.rename(columns={0: "source", 1: "timestamp", 2: "src_link", 3: "target", 4: "full_link"}, inplace=True)
-        df.to_csv(output_path)
+        # Only regular expression replacements and searches are used, which pandas runs natively on Arrow strings
+        lines = lines[lines.str.contains('∞', regex=False)]
+        src = lines.str.replace(r'∞.*$', '', regex=True)
+        ext = lines.str.replace(r'^[^∞]*∞', '', regex=True)
+
+        keep = ext.str.contains(WAYBACK_PREFIX, regex=False)
+        keep &= ~ext.str.lower().str.contains("mailto", regex=False)
+        keep &= ~ext.str.contains(self.source[:-4], regex=False)
+        keep &= ~ext.str.contains("WB_wombat", regex=False)
+        src, ext = src[keep], ext[keep]
+
+        # The original url follows the scheme embedded in the path of the Wayback url
+        ia_link = ext.str.replace(r'^[^:/?#]+://[^/?#]*', '', regex=True).str.replace(r'#.*$', '', regex=True) \
+            .str.replace('?', '', n=1, regex=False)
+        # Sources are formatted as [domain]/[timestamp]_[url_key with slashes replaced by underscores]
+        valid = ia_link.str.contains(r'/[a-z]{3,5}://', regex=True) & src.str.contains(r'^[^_/]*/', regex=True)
+        self.no_link.extend(ext[~valid].tolist())
+        src, ia_link = src[valid], ia_link[valid]
+
+        full_link = ia_link.str.replace(r'^.*?/[a-z]{3,5}://', '', regex=True)
+        host = full_link.str.replace(r'^(?:[^/?#@]*@)?([^/?#:]*).*$', r'\1', regex=True).str.lower().str.rstrip('.')
+
+        # Pages link to the same hosts over and over, thus match every distinct host once
+        hosts = host.unique()
+        target = host.map(dict(zip(hosts, map(self.targets.match, hosts))))
+        matched = target.notna()
+
+        src = src[matched]
+        return pd.DataFrame({
+            "source": src.str.replace(r'^([^_/]*)/.*$', r'\1', regex=True),
+            "timestamp": src.str.replace(r'^[^_/]*/([^_/]*).*$', r'\1', regex=True),
+            "src_link": src.str.replace(r'^[^_]*(?:_|$)', '', regex=True).str.replace('_', '/', regex=False),
+            "target": target[matched],
+            "full_link": full_link[matched],
+        }, columns=OUTPUT_COLUMNS)
+
+
+def to_edges(links: pd.DataFrame) -> pd.DataFrame:
+    """
+    Type the columns of external links as edges.
+    :param links: Frame with the OUTPUT_COLUMNS.
+    :return: Frame with the columns of EDGE_SCHEMA.
+    """
+    timestamps = links["timestamp"].astype(str)
+    return pd.DataFrame({
+        "timestamp": pd.to_numeric(timestamps, errors="coerce").astype("Int64"),
+        "src_link": links["src_link"],
+        "target": links["target"],
+        "full_link": links["full_link"],
+        "year": pd.to_numeric(timestamps.str.slice(0, 4), errors="coerce").astype("Int16"),
+    })
+
+
+def to_table(frame: pd.DataFrame, schema: "pyarrow.Schema") -> "pyarrow.Table":
+    """
+    Convert a frame to an Arrow table without pandas metadata. The metadata would record the nullable pandas types of
+    the columns, which pandas cannot restore for the year partition, read back as a dictionary column.
+    :param frame: Frame with the columns of the schema.
+    :param schema: Schema of the table.
+    :return: Table.
+    """
+    return pyarrow.Table.from_pandas(frame, schema=schema, preserve_index=False).replace_schema_metadata(None)
+
+
+def consolidate_weights(weights_folder: Path, output_path: Path) -> int:
+    """
+    Combine the edge weights of all organisations into a single (source, target, year, count) table.
+    :param weights_folder: Folder with the edge weights per organisation.
+    :param output_path: Path to the combined table.
+    :return: Amount of edges.
+    """
+    dataset = pyarrow.dataset.dataset(str(weights_folder), format="parquet", partitioning="hive")
+    table = dataset.to_table(columns=["source", "target", "year", "count"]).replace_schema_metadata(None)
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    pyarrow.parquet.write_table(table, str(tmp_path))
+    os.replace(str(tmp_path), str(output_path))
+    return table.num_rows
+
+
+def up_to_date(input_file: Path, output_file: Path, targets_path: Path) -> bool:
+    """
+    Whether the output of an organisation is newer than its links and the list of targets.
+    :param input_file: Path to the links of the organisation.
+    :param output_file: Path to the external links of the organisation.
+    :param targets_path: Path to the list of target domains.
+    :return: Whether the organisation can be skipped.
+    """
+    if not output_file.exists():
+        return False
+    modified = output_file.stat().st_mtime
+    return modified >= input_file.stat().st_mtime and modified >= targets_path.stat().st_mtime
+
+
+def list_organisation(organisation_domain: str, input_file: Path, output_file: Path, targets_path: Path,
+                      edges_folder: Path = None) -> str:
+    """
+    List the external links of an organisation in a worker process. The targets are loaded once per process.
+    :param organisation_domain: Domain of the organisation.
+    :param input_file: Path to the links of the organisation.
+    :param output_file: Path to the external links of the organisation, or to its edge weights for Parquet output.
+    :param targets_path: Path to the list of target domains.
+    :param edges_folder: Folder of the edge dataset, if the output is Parquet.
+    :return: Domain of the organisation.
+    """
+    lister = ExtLinkLister(organisation_domain, targets_path)
+    if edges_folder is not None:
+        lister.write_edges(input_file, edges_folder, output_file)
+    else:
+        lister.list_ext_links(input_file, output_file)
+    return organisation_domain
 
 
 def main():
@@ -126,18 +343,56 @@ def main():
     parser.add_argument("--input_data", "-i", help="Input folder containing organisations", default="../output/html")
     parser.add_argument("--input_folder", help="Input folder containing organisations", default="../output/lynx")
     parser.add_argument("--output_folder", help="Output folder to write results to", default="../output/dummy_data")
+    parser.add_argument("--processes", help="Amount of worker processes, defaults to the amount of cpu cores",
+                        type=int, default=None)
+    parser.add_argument("--force", help="Also process organisations whose output is up to date", action="store_true")
+    parser.add_argument("--output_format", help="Write a csv file per organisation, or a single edge dataset and edge "
+                                                "weights in Parquet", choices=["csv", "parquet"], default="csv")
     args = parser.parse_args()
     Path(args.output_folder).mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s', datefmt='%H:%M:%S')
 
     targets_file = Path("organisations.txt")
+    output_folder = Path(args.output_folder)
+    edges_folder = output_folder / EDGES_FOLDER if args.output_format == "parquet" else None
+    if edges_folder is not None and pyarrow is None:
+        raise ImportError("Parquet output requires pyarrow, install it using 'pip install pyarrow'")
 
+    jobs = []
     organisation_folders = [inode for inode in Path(args.input_data).glob("*") if inode.is_dir()]
     for org in organisation_folders:
         organisation_domain = org.stem + ".".join(org.suffixes)
         input_file = Path(args.input_folder) / f"{organisation_domain}_links"
-        output_file = Path(args.output_folder) / f"{organisation_domain}_ext_links.csv"
-        s = ExtLinkLister(organisation_domain, targets_file)
-        s.list_ext_links(input_file, output_file)
+        if edges_folder is not None:
+            output_file = output_folder / EDGE_WEIGHTS_FOLDER / f"source={organisation_domain}" / "weights.parquet"
+        else:
+            output_file = output_folder / f"{organisation_domain}_ext_links.csv"
+        if not input_file.exists():
+            logging.getLogger().warning(f"Skipping {organisation_domain}, {input_file} does not exist")
+        elif args.force or not up_to_date(input_file, output_file, targets_file):
+            jobs.append((organisation_domain, input_file, output_file))
+    logging.getLogger().info(f"Processing {len(jobs)} organisations, {len(organisation_folders) - len(jobs)} are "
+                             f"skipped")
+
+    # Largest organisations first, so they do not end up last on a single worker
+    jobs.sort(key=lambda job: job[1].stat().st_size, reverse=True)
+    failed = 0
+    with ProcessPoolExecutor(args.processes) as pool:
+        futures = {pool.submit(list_organisation, domain, input_file, output_file, targets_file, edges_folder): domain
+                   for domain, input_file, output_file in jobs}
+        for future in as_completed(futures):
+            try:
+                logging.getLogger().info(f"Written external links of {future.result()}")
+            except Exception as e:
+                failed += 1
+                logging.getLogger().error(f"Exception occurred while processing {futures[future]}")
+                logging.getLogger().exception(e)
+    if failed:
+        logging.getLogger().error(f"{failed} organisations failed")
+
+    if edges_folder is not None and (output_folder / EDGE_WEIGHTS_FOLDER).exists():
+        edges = consolidate_weights(output_folder / EDGE_WEIGHTS_FOLDER, output_folder / EDGE_WEIGHTS_FILE)
+        logging.getLogger().info(f"Written {edges} weighted edges to {output_folder / EDGE_WEIGHTS_FILE}")
 
 
 if __name__ == "__main__":
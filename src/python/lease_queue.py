@@ -0,0 +1,333 @@
+import argparse
+import csv
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import requests
+
+PENDING = 0
+LEASED = 1
+DONE = 2
+
+
+class LeaseQueue:
+    def __init__(self, path: Path, lease_size: int = 100, lease_timeout: float = 600.0):
+        """
+        Queue of CDX records shared by a fleet of page fetchers, backed by a SQLite database. Workers take small leases
+        of records whenever they have room for more work, and complete them when all of their records are finished.
+        Leases that are neither completed nor renewed before they expire return to the queue, so the records of a
+        crashed or stalled worker are taken over by the others.
+
+        :param path: Path to the SQLite database, created if it does not exist. Processes on other hosts must use a
+            LeaseServer, as the write-ahead log of the database does not work on network file systems.
+        :param lease_size: Maximum amount of records per lease.
+        :param lease_timeout: Amount of seconds after which a lease that has not been renewed expires.
+        """
+        self.path = path
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        # The coordinator serves requests from several threads, thus serialise them
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                url_key TEXT NOT NULL,
+                state INTEGER NOT NULL DEFAULT 0,
+                lease_id TEXT,
+                UNIQUE (timestamp, url_key)
+            );
+            CREATE INDEX IF NOT EXISTS records_state ON records (state, id);
+            CREATE INDEX IF NOT EXISTS records_lease ON records (lease_id);
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_id TEXT PRIMARY KEY,
+                worker TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+        """)
+
+    def __transaction(self):
+        # Take the write lock up front, so workers sharing the database file never take the same records
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def load(self, records: Iterable[Tuple[str, str]]) -> int:
+        """
+        Add records to the queue. Records that are queued already are ignored, so loading the same data twice is safe.
+
+        :param records: Iterable of (timestamp, url_key) tuples.
+        :return: Amount of records added.
+        """
+        with self._lock:
+            before = self._connection.total_changes
+            self.__transaction()
+            try:
+                self._connection.executemany("INSERT OR IGNORE INTO records (timestamp, url_key) VALUES (?, ?)",
+                                             records)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            return self._connection.total_changes - before
+
+    def acquire(self, worker: str) -> Tuple[Optional[str], List[Tuple[str, str]]]:
+        """
+        Lease the next pending records. Expired leases are returned to the queue first.
+
+        :param worker: Name of the worker, used for logging.
+        :return: Id of the lease and its (timestamp, url_key) records. The id is None if no records are pending.
+        """
+        with self._lock:
+            now = time.time()
+            self.__transaction()
+            try:
+                self.__expire(now)
+                rows = self._connection.execute("SELECT id, timestamp, url_key FROM records WHERE state = ? "
+                                                "ORDER BY id LIMIT ?", (PENDING, self.lease_size)).fetchall()
+                if not rows:
+                    self._connection.execute("COMMIT")
+                    return None, []
+
+                lease_id = uuid.uuid4().hex
+                self._connection.execute("INSERT INTO leases (lease_id, worker, expires) VALUES (?, ?, ?)",
+                                         (lease_id, worker, now + self.lease_timeout))
+                self._connection.executemany("UPDATE records SET state = ?, lease_id = ? WHERE id = ?",
+                                             [(LEASED, lease_id, row[0]) for row in rows])
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return lease_id, [(row[1], row[2]) for row in rows]
+
+    def renew(self, lease_ids: List[str]) -> List[str]:
+        """
+        Extend leases that are still being worked on.
+
+        :param lease_ids: Ids of the leases to renew.
+        :return: Ids of the leases that had expired already, whose records may be fetched by another worker.
+        """
+        with self._lock:
+            expires = time.time() + self.lease_timeout
+            lost = []
+            self.__transaction()
+            try:
+                for lease_id in lease_ids:
+                    cursor = self._connection.execute("UPDATE leases SET expires = ? WHERE lease_id = ?",
+                                                      (expires, lease_id))
+                    if cursor.rowcount == 0:
+                        lost.append(lease_id)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return lost
+
+    def complete(self, lease_id: str) -> None:
+        """
+        Mark all records of a lease as done, whatever their outcome. Completing an expired lease still marks its
+        records as done, unless they have been leased again, as expired records keep the id of their last lease.
+
+        :param lease_id: Id of the lease.
+        """
+        with self._lock:
+            self.__transaction()
+            try:
+                self._connection.execute("UPDATE records SET state = ? WHERE lease_id = ? AND state != ?",
+                                         (DONE, lease_id, DONE))
+                self._connection.execute("DELETE FROM leases WHERE lease_id = ?", (lease_id,))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def outstanding(self) -> int:
+        """
+        Amount of leases that have been neither completed nor expired.
+        :return: Amount of leases.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+
+    def counts(self) -> dict:
+        """
+        Amount of records per state.
+        :return: Dictionary with the amount of pending, leased and done records.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT state, COUNT(*) FROM records GROUP BY state").fetchall()
+        counts = dict(rows)
+        return {"pending": counts.get(PENDING, 0), "leased": counts.get(LEASED, 0), "done": counts.get(DONE, 0)}
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __expire(self, now: float) -> None:
+        expired = self._connection.execute("SELECT lease_id, worker FROM leases WHERE expires < ?", (now,)).fetchall()
+        for lease_id, worker in expired:
+            logging.getLogger().warning(f"Lease {lease_id} of {worker} expired, returning its records to the queue")
+            self._connection.execute("UPDATE records SET state = ? WHERE lease_id = ? AND state = ?",
+                                     (PENDING, lease_id, LEASED))
+            self._connection.execute("DELETE FROM leases WHERE lease_id = ?", (lease_id,))
+
+
+class LeaseClient:
+    def __init__(self, url: str, timeout: float = 30.0):
+        """
+        Client of a LeaseServer, with the same interface as the LeaseQueue it serves.
+
+        :param url: Url of the coordinator, i.e. http://10.0.0.1:8421.
+        :param timeout: Amount of seconds to wait for the coordinator.
+        """
+        self.url = url.rstrip("/")
+        self._timeout = timeout
+        self._session = requests.Session()
+
+    def __post(self, path: str, body: dict) -> dict:
+        response = self._session.post(self.url + path, json=body, timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def __get(self, path: str) -> dict:
+        response = self._session.get(self.url + path, timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def acquire(self, worker: str) -> Tuple[Optional[str], List[Tuple[str, str]]]:
+        response = self.__post("/acquire", {"worker": worker})
+        return response["lease_id"], [tuple(record) for record in response["records"]]
+
+    def renew(self, lease_ids: List[str]) -> List[str]:
+        return self.__post("/renew", {"lease_ids": lease_ids})["lost"]
+
+    def complete(self, lease_id: str) -> None:
+        self.__post("/complete", {"lease_id": lease_id})
+
+    def outstanding(self) -> int:
+        return self.__get("/outstanding")["leases"]
+
+    def counts(self) -> dict:
+        return self.__get("/counts")
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class LeaseHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/counts":
+            self.__respond(200, self.server.queue.counts())
+        elif self.path == "/outstanding":
+            self.__respond(200, {"leases": self.server.queue.outstanding()})
+        else:
+            self.__respond(404, {"error": "Unknown path"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        queue = self.server.queue
+        if self.path == "/acquire":
+            lease_id, records = queue.acquire(body["worker"])
+            self.__respond(200, {"lease_id": lease_id, "records": records})
+        elif self.path == "/renew":
+            self.__respond(200, {"lost": queue.renew(body["lease_ids"])})
+        elif self.path == "/complete":
+            queue.complete(body["lease_id"])
+            self.__respond(200, {})
+        else:
+            self.__respond(404, {"error": "Unknown path"})
+
+    def __respond(self, status: int, body: dict) -> None:
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        logging.getLogger().debug(format % args)
+
+
+class LeaseServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, queue: LeaseQueue, host: str = "0.0.0.0", port: int = 8421):
+        """
+        Coordinator that serves the leases of a LeaseQueue over HTTP to the page fetchers of the fleet.
+
+        :param queue: Queue to serve.
+        :param host: Address to listen on.
+        :param port: Port to listen on.
+        """
+        super().__init__((host, port), LeaseHandler)
+        self.queue = queue
+
+
+def open_lease_queue(location: str, lease_size: int = 100, lease_timeout: float = 600.0):
+    """
+    Open a queue of leases, either served by a coordinator or stored in a local SQLite database.
+
+    :param location: Url of a coordinator, or path to a SQLite database.
+    :param lease_size: Maximum amount of records per lease, only used for a SQLite database.
+    :param lease_timeout: Amount of seconds after which a lease expires, only used for a SQLite database.
+    :return: LeaseClient or LeaseQueue.
+    """
+    if location.startswith(("http://", "https://")):
+        return LeaseClient(location)
+    return LeaseQueue(Path(location), lease_size, lease_timeout)
+
+
+def read_records(csv_path: Path) -> Iterable[Tuple[str, str]]:
+    """
+    Read the records of a csv file formatted as (timestamp, url_key). The header of the csv files of
+    cdx_record_fetcher is skipped, shards have no header.
+
+    :param csv_path: Path to the csv data.
+    :return: Generator of (timestamp, url_key) tuples.
+    """
+    with open(str(csv_path), 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) >= 2 and row[0].isdigit():
+                yield row[0], row[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hand out leases of CDX records to the page fetchers of the fleet.')
+    parser.add_argument("--database", help="Path to the SQLite database of the queue", default="./leases.sqlite")
+    parser.add_argument("--data", "-d", help="Paths to csv data formatted as (timestamp, url) to add to the queue",
+                        nargs="*", default=[])
+    parser.add_argument("--host", help="Address to listen on", default="0.0.0.0")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8421)
+    parser.add_argument("--lease_size", help="Maximum amount of records per lease", type=int, default=100)
+    parser.add_argument("--lease_timeout", help="Amount of seconds after which a lease that has not been renewed "
+                                                "returns to the queue", type=float, default=600.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+    queue = LeaseQueue(Path(args.database), args.lease_size, args.lease_timeout)
+    for path in args.data:
+        added = queue.load(read_records(Path(path)))
+        logging.getLogger().info(f"Added {added} records of {path}")
+    logging.getLogger().info(f"Queue: {queue.counts()}")
+
+    server = LeaseServer(queue, args.host, args.port)
+    logging.getLogger().info(f"Serving leases on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
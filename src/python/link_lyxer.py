@@ -1,10 +1,17 @@
 import argparse
 import logging
-import subprocess
+import os
+import re
 import sys
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from html.parser import HTMLParser
+from itertools import islice
 from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlsplit
 
-from joblib import Parallel, delayed
+from page_store import ALIASES_SUFFIX, iter_documents, read_aliases, read_document
 from tqdm import tqdm
 
 # Check Python version
@@ -12,95 +19,320 @@ if sys.version_info < (3, 7):
     sys.stdout.write("This script requires Python 3.7 or higher\n")
     sys.exit(1)
 
+WAYBACK_URL = "http://web.archive.org/web"
+# Url of a capture: the Wayback Machine prefix, followed by the original url
+WAYBACK_CAPTURE = re.compile(r"^(https?://web\.archive\.org/web/[^/]+/)(.*)$")
+
+DELIMITER = '∞'
+PARTIAL_SUFFIX = ".partial"
+
+# Elements lynx lists as links, and the attribute holding their url
+LINK_ATTRIBUTES = {
+    "a": "href",
+    "area": "href",
+    "frame": "src",
+    "iframe": "src",
+}
+
+
+class LinkExtractor(HTMLParser):
+    def __init__(self):
+        """
+        Collects the links of a html document in document order, like the link list of lynx with
+        -hiddenlinks=merge: links without any visible text are listed as well.
+        """
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "base" and self.base is None:
+            self.base = next((value for name, value in attrs if name == "href" and value), None)
+            return
+
+        attribute = LINK_ATTRIBUTES.get(tag)
+        if attribute is None:
+            return
+        for name, value in attrs:
+            if name == attribute and value and value.strip():
+                self.links.append(value.strip())
+                return
+
+
+def page_url(page_name: str) -> str:
+    """
+    Url of a fetched page on the Wayback Machine. Slashes in the url_key were replaced with underscores in the page
+    name, thus underscores in the original url cannot be told apart and become slashes as well. The url_key has no
+    scheme, which is added so relative links keep the host of the original url.
+
+    :param page_name: Name of the page, i.e. 20180806145630_uu.nl_en_research.
+    :return: Url of the page, i.e. http://web.archive.org/web/20180806145630/http://uu.nl/en/research.
+    """
+    timestamp, _, url_key = page_name.partition('_')
+    return f"{WAYBACK_URL}/{timestamp}/http://{url_key.replace('_', '/')}"
+
+
+def join_url(base_url: str, link: str) -> str:
+    """
+    Resolve a link against the url of a capture. Document-relative links are resolved against the original url, as
+    resolving them against the capture would collapse the '//' of the original url. The scheme of absolute links is
+    lowercased, like lynx does.
+
+    :param base_url: Url of the capture.
+    :param link: Link as found in the document.
+    :return: Absolute link.
+    """
+    scheme = urlsplit(link).scheme
+    if scheme:
+        link = scheme + link[len(scheme):]
+    match = WAYBACK_CAPTURE.match(base_url)
+    if match is None or link.startswith('/') or scheme:
+        return urljoin(base_url, link)
+    prefix, original = match.groups()
+    return prefix + urljoin(original, link)
+
+
+def extract_links(html: str, base_url: str) -> List[str]:
+    """
+    Extract the unique links of a html document, like lynx -dump -listonly -unique_urls -hiddenlinks=merge.
+    Relative links are resolved against the base element of the document, or the url of the page, and fragments are
+    removed.
+
+    :param html: Html of the document.
+    :param base_url: Url of the page.
+    :return: Sorted list of absolute links.
+    """
+    extractor = LinkExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return resolve_links(extractor, base_url)
+
+
+def resolve_links(extractor: LinkExtractor, base_url: str) -> List[str]:
+    """
+    Resolve the links collected by an extractor against the url of a page.
+
+    :param extractor: Extractor that has been fed a document.
+    :param base_url: Url of the page.
+    :return: Sorted list of unique absolute links without fragments.
+    """
+    links = set()
+    try:
+        if extractor.base:
+            base_url = join_url(base_url, extractor.base)
+    except ValueError:
+        pass
+    for link in extractor.links:
+        try:
+            links.add(urldefrag(join_url(base_url, link))[0])
+        except ValueError:  # Malformed urls, i.e. invalid IPv6 hosts
+            continue
+    return sorted(links)
+
 
 class LinkFetcher:
     @staticmethod
-    def get_links(filepath: Path) -> list:
+    def get_links(filepath: Path, offset: Optional[int], organisation_domain: str, page_names: List[str]) -> list:
         """
-        Get links using lynx.
-        :param filepath: Html file to extract links from.
-        :return: List of lynx.
+        Get links of a html document. The document is parsed once, and its links are resolved for each page sharing it.
+        :param filepath: Html document to extract links from, possibly compressed.
+        :param offset: Offset of the document within a segment file, if any.
+        :param organisation_domain: Domain of the organisation the document belongs to.
+        :param page_names: Names of all pages sharing the document.
+        :return: List of source∞destination rows.
         """
-        command = """lynx \
-             -dump \
-             -listonly \
-             -unique_urls \
-             -hiddenlinks=merge \
-             -nonumbers \
-             '{}' \
-             | sed 's/#.*//' \
-             | sort \
-             | uniq""".format(filepath)
-
-        output = subprocess.run(command,
-                                shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                check=True,
-                                text=True)
-
-        if output.stderr is not None:
-            raise RuntimeError("Exception occurred while fetching links\nCommand:{}\nOutput:{}"
-                               .format(command, output.stderr))
-
-        # Command assumed to have succeeded
-        links = str(output.stdout).split('\n')
-        src = '/'.join(filepath.parts[3:5])
+        extractor = LinkExtractor()
+        extractor.feed(read_document(filepath, offset).decode("utf-8", errors="replace"))
+        extractor.close()
+
         combined = []
-        for i in range(len(links)):
-            combined.append('∞'.join([src, links[i]]))
+        for page_name in page_names:
+            src = '/'.join([organisation_domain, page_name])
+            for link in resolve_links(extractor, page_url(page_name)):
+                combined.append(DELIMITER.join([src, link]))
         return combined
 
-    @staticmethod
-    def write_to_file(output_file: Path, data: list) -> None:
+
+class LinkWriter:
+    def __init__(self, output_file: Path):
         """
-        Write data to file.
-        :param output_file: Path to output file.
-        :param data: List to write.
+        Appends the links of an organisation to a partial file as soon as a page has been processed, which replaces the
+        output file once all pages are done. After a crash, the partial file is resumed: only the pages that were not
+        written completely are processed again.
+
+        :param output_file: Path to the output file.
+        """
+        self.output_file = output_file
+        self.partial_file = output_file.with_name(output_file.name + PARTIAL_SUFFIX)
+        self.completed = self.__recover()
+        self._file = open(str(self.partial_file), 'a', encoding='utf-8')
+
+    def __recover(self) -> Set[str]:
+        """
+        Read the sources written by a previous run, and truncate the rows of the last one, which may be incomplete.
+        :return: Sources whose links have been written completely.
+        """
+        if not self.partial_file.exists():
+            return set()
+
+        completed = set()
+        delimiter = DELIMITER.encode('utf-8')
+        last_source = None
+        last_start = offset = 0
+        with open(str(self.partial_file), 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                source = line.split(delimiter, 1)[0]
+                if source != last_source:
+                    if last_source is not None:
+                        completed.add(last_source.decode('utf-8'))
+                    last_source, last_start = source, offset
+                offset += len(line)
+        with open(str(self.partial_file), 'ab') as file:
+            file.truncate(last_start)
+        if completed:
+            logging.getLogger().info(f"Resuming {self.partial_file} after {len(completed)} pages")
+        return completed
+
+    def write(self, rows: Iterable[str]) -> None:
         """
-        with open(str(output_file), 'w') as f:
-            for item in data:
-                f.write("%s\n" % item)
+        Append the links of a page.
 
+        :param rows: Rows formatted as source∞destination.
+        """
+        self._file.write(''.join(row + '\n' for row in rows))
+        self._file.flush()
 
-def process_organisation(organisation_folder: Path, output_folder: Path, log_file: Path) -> list:
+    def close(self) -> None:
+        """
+        Replace the output file with the partial file.
+        """
+        self._file.close()
+        os.replace(str(self.partial_file), str(self.output_file))
+
+
+def organisation_domain(organisation_folder: Path) -> str:
+    return organisation_folder.stem + ".".join(organisation_folder.suffixes)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterable[list]:
     """
-    Extract all links for all html files of an individual organisation.
-    :param organisation_folder: Path to the organisation' html files.
-    :param output_folder: Output folder.
-    :param log_file:
-    :return failed: list of html pages that could not be processed
-    """
-    organisation_domain = organisation_folder.stem + ".".join(organisation_folder.suffixes)
-    output_file = output_folder / Path(f"{organisation_domain}_links")
-
-    all_links = []
-    html_files = [inode for inode in organisation_folder.glob("*") if inode.is_file()]
-    failed = []
-
-    def process_single_page(html_file: Path) -> list:
-        logging.basicConfig(
-            filename=str(log_file),
-            level=logging.INFO,
-            format='[%(asctime)s] {%(threadName)s:%(lineno)d} %(levelname)s - %(message)s',
-            datefmt='%H:%M:%S'
-        )
+    Split an iterable in lists of at most size items, without reading it ahead.
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def init_worker(log_file: Path) -> None:
+    """
+    Initialise logging of a worker process once, rather than for every page.
+
+    :param log_file: Path to the log file.
+    """
+    logging.basicConfig(
+        filename=str(log_file),
+        level=logging.INFO,
+        format='[%(asctime)s] {%(processName)s:%(lineno)d} %(levelname)s - %(message)s',
+        datefmt='%H:%M:%S'
+    )
+
+
+def process_documents(documents: List[Tuple[str, List[str], Path, Optional[int]]]) -> List[Tuple[str, list]]:
+    """
+    Extract the links of a chunk of documents in a worker process.
+
+    :param documents: List of (organisation domain, page names, path to the document, offset) tuples.
+    :return: List of (organisation domain, rows) tuples, one per document. The rows are None if the document could not
+    be processed.
+    """
+    results = []
+    for domain, page_names, html_file, offset in documents:
         try:
-            return LinkFetcher().get_links(html_file)
-        except UnicodeDecodeError:
-            logging.error(f"Unicode decoding error occurred while processing {html_file}")
-            pass
+            results.append((domain, LinkFetcher.get_links(html_file, offset, domain, page_names)))
         except Exception as e:
             logging.error(f"Exception occurred while processing {html_file}")
             logging.exception(e)
+            results.append((domain, None))
+    return results
+
+
+def process_organisations(organisation_folders: List[Path], output_folder: Path, log_file: Path,
+                          processes: int = None, chunk_size: int = 64, aliases_folder: Path = None) -> None:
+    """
+    Extract all links for all html files of the organisations. All organisations share one pool of worker processes,
+    which is handed chunks of documents regardless of the organisation they belong to, so small organisations do not
+    leave workers idle. The links of an organisation are written as its documents are processed.
+
+    :param organisation_folders: Paths to the html files of each organisation.
+    :param output_folder: Output folder.
+    :param log_file: Path to the log file.
+    :param processes: Amount of worker processes. Defaults to the amount of cpu cores.
+    :param chunk_size: Amount of documents handed to a worker at once.
+    :param aliases_folder: Folder with the [domain].aliases.csv files of cdx_record_fetcher. The links of a fetched
+    page are listed for the pages that were not fetched as they are identical to it as well.
+    """
+    processes = processes or os.cpu_count()
+    writers = {}
+    pending = Counter()
+    listed = set()
+    finished = set()
+    progress = tqdm(unit="pages")
+
+    def finish(domain: str) -> None:
+        # An organisation is done once all of its documents are listed and processed
+        if domain in listed and pending[domain] == 0 and domain not in finished:
+            writers.pop(domain).close()
+            finished.add(domain)
+            progress.set_postfix(organisations=f"{len(finished)}/{len(organisation_folders)}")
+            logging.getLogger().info(f"Successfully written to file {output_folder / f'{domain}_links'}")
 
-    results = Parallel(n_jobs=-1)(delayed(process_single_page)(html_file) for html_file in tqdm(html_files))
-    for result in results:
-        if result and result[0]:
-            all_links.extend(result)
-    LinkFetcher.write_to_file(output_file, data=all_links)
+    def documents():
+        # Documents are listed lazily, and pages written by a previous run are skipped
+        for organisation_folder in organisation_folders:
+            domain = organisation_domain(organisation_folder)
+            writer = writers[domain] = LinkWriter(output_folder / f"{domain}_links")
+            aliases = {}
+            if aliases_folder is not None and (aliases_folder / f"{domain}{ALIASES_SUFFIX}").exists():
+                aliases = read_aliases(aliases_folder / f"{domain}{ALIASES_SUFFIX}")
+            for page_names, html_file, offset in iter_documents(organisation_folder):
+                page_names = page_names + [alias for name in page_names for alias in aliases.get(name, ())]
+                page_names = [name for name in page_names if f"{domain}/{name}" not in writer.completed]
+                if page_names:
+                    pending[domain] += 1
+                    yield domain, page_names, html_file, offset
+            listed.add(domain)
+            finish(domain)
 
-    logging.getLogger().info(f'Successfully written to file {output_file}')
+    chunks = chunked(documents(), chunk_size)
+    with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(log_file,)) as pool:
+        # Keep a few chunks per worker in flight, so workers never wait while the memory use stays bounded
+        in_flight = set(pool.submit(process_documents, chunk) for chunk in islice(chunks, 2 * processes))
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                for domain, rows in results:
+                    if rows:
+                        writers[domain].write(rows)
+                    pending[domain] -= 1
+                    finish(domain)
+                progress.update(len(results))
+                in_flight.update(pool.submit(process_documents, chunk) for chunk in islice(chunks, 1))
+    progress.close()
+
+
+def process_organisation(organisation_folder: Path, output_folder: Path, log_file: Path) -> None:
+    """
+    Extract all links for all html files of an individual organisation.
+    :param organisation_folder: Path to the organisation' html files.
+    :param output_folder: Output folder.
+    :param log_file: Path to the log file.
+    """
+    process_organisations([organisation_folder], output_folder, log_file)
 
 
 def init_logging(log_file: Path) -> None:
@@ -134,6 +366,13 @@ def main():
                         default="../output/html")
     parser.add_argument("--output_folder", help="Output folder to write results to", default="../output/lynx")
     parser.add_argument("--log", "-l", help="Path to log file", default="../output/log2.txt")
+    parser.add_argument("--processes", help="Amount of worker processes, defaults to the amount of cpu cores",
+                        type=int, default=None)
+    parser.add_argument("--chunk_size", help="Amount of documents handed to a worker process at once", type=int,
+                        default=64)
+    parser.add_argument("--aliases_folder", help="Folder with the [domain].aliases.csv files of cdx_record_fetcher, "
+                                                 "to list the links of captures that were skipped as duplicates",
+                        default=None)
     args = parser.parse_args()
     Path(args.output_folder).mkdir(parents=True, exist_ok=True)
 
@@ -141,12 +380,8 @@ def main():
 
     organisation_folders = [inode for inode in Path(args.input_folder).glob("*") if inode.is_dir()]
 
-    failed_file = Path("../output/failed.txt")
-    all_failed = []
-
-    for f in organisation_folders:
-        process_organisation(f, Path(args.output_folder), Path(args.log))
-
+    process_organisations(organisation_folders, Path(args.output_folder), Path(args.log), args.processes,
+                          args.chunk_size, Path(args.aliases_folder) if args.aliases_folder else None)
 
 
 if __name__ == "__main__":
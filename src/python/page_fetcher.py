@@ -1,104 +1,737 @@
 import argparse
+import asyncio
 import boto3
+import codecs
 import csv
+import heapq
 import logging
 import htmlmin
+import multiprocessing
+import os
+import queue
+import random
+import re
 import requests
+import socket
 import sys
+import threading
 import time
 import tldextract
 
-from htmlmin import parser
-from multiprocessing.dummy import Pool
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from lease_queue import open_lease_queue
 from math import log, ceil
+from page_store import COMPRESSION_SUFFIXES, INDEX_SUFFIX, MANIFEST_PREFIX, OBJECTS_FOLDER, SEGMENT_SUFFIX, \
+    SegmentWriter, compress, content_digest, encode_record, page_name, read_manifest, recover_segment
 from pathlib import Path
-from requests import Response
-from time import sleep
+from rate_limit import RATE_CONTROLLERS, TokenBucket, parse_retry_after
+from requests.adapters import HTTPAdapter
+from typing import Callable, List, Optional, Set, Tuple
+
+try:
+    import aiohttp
+except ImportError:  # Only required for the asyncio engine
+    aiohttp = None
+
+
+class BodyTooLargeError(ValueError):
+    pass
+
+
+# Exceptions that indicate an overloaded server, next to status codes 429 and 5xx
+THROTTLE_EXCEPTIONS = (requests.Timeout, requests.ConnectionError, asyncio.TimeoutError)
+if aiohttp is not None:
+    THROTTLE_EXCEPTIONS += (aiohttp.ClientConnectionError,)
+
+# Exceptions of the store that may not occur again when the page is fetched and uploaded again
+TRANSIENT_UPLOAD_EXCEPTIONS = (BotoCoreError, ClientError, OSError)
+
+# Attempts of a request to the lease coordinator, waiting up to a minute between attempts
+COORDINATOR_ATTEMPTS = 8
 
 
 # Check Python version
-if sys.version_info < (3, 6):
-    sys.stdout.write("This script requires Python 3.4 or higher\n")
+if sys.version_info < (3, 7):
+    sys.stdout.write("This script requires Python 3.7 or higher\n")
     sys.exit(1)
 
+WAYBACK_URL = "http://web.archive.org/web"
+
 s3 = boto3.resource("s3")
 
 
-class Counter:
-    def __init__(self, limit: int = 10):
+def configure_s3(endpoint_url: str = None) -> None:
+    """
+    Point the S3 client at another S3-compatible endpoint, e.g. a local stand-in for benchmarks.
+
+    :param endpoint_url: Url of the endpoint. Defaults to Amazon S3.
+    """
+    global s3
+    s3 = boto3.resource("s3", endpoint_url=endpoint_url)
+
+
+class BoundedPool:
+    def __init__(self, name: str, processes: int, queue_size: int = None):
+        """
+        Thread pool with a bounded task queue. Submitting a task blocks while the queue is full, so a slow consumer
+        slows down its producer instead of piling up work in memory.
+
+        :param name: Name of the pool, used for the thread names.
+        :param processes: Amount of worker threads.
+        :param queue_size: Maximum amount of waiting tasks. Defaults to twice the amount of worker threads.
+        """
+        self._queue = queue.Queue(maxsize=queue_size or 2 * processes)
+        self._threads = [threading.Thread(target=self.__work, name=f"{name}-{i}", daemon=True)
+                         for i in range(processes)]
+        for thread in self._threads:
+            thread.start()
+
+    def apply_async(self, func: Callable, args: list = (), callback: Callable = None,
+                    error_callback: Callable = None) -> None:
+        """
+        Submit a task, blocking while the queue is full.
+
+        :param func: Function to call.
+        :param args: Arguments of the function.
+        :param callback: Called with the result of the function.
+        :param error_callback: Called with the exception raised by the function.
+        """
+        self._queue.put((func, args, callback, error_callback))
+
+    def join(self) -> None:
+        """
+        Wait for all submitted tasks to finish and stop the worker threads.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __work(self) -> None:
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            func, args, callback, error_callback = task
+            try:
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    if error_callback is not None:
+                        error_callback(e)
+                    continue
+                if callback is not None:
+                    callback(result)
+            except Exception as e:
+                logging.getLogger().error("Exception occurred in a callback")
+                logging.getLogger().exception(e)
+
+
+class ProgressJournal:
+    UPLOADED = "uploaded"
+    NOT_FOUND = "404"
+    FAILED = "failed"
+
+    def __init__(self, path: Path, batch_size: int = 1000, flush_interval: float = 5.0,
+                 before_sync: Callable[[], None] = None):
+        """
+        Append-only journal of records that have been completed. Outcomes are written in batches, and only batch
+        boundaries are synced to disk, so a crash loses at most one batch, which is then fetched again.
+
+        :param path: Path to the journal file.
+        :param batch_size: Amount of outcomes after which a batch is flushed.
+        :param flush_interval: Amount of seconds after which a batch is flushed.
+        :param before_sync: Called before a batch is synced, i.e. to sync the pages it records as uploaded.
+        """
+        self.path = path
+        self._before_sync = before_sync
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._batch = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def completed(self) -> Set[Tuple[str, str]]:
+        """
+        Read all records that have been completed in previous runs.
+        :return: Set of (timestamp, url_key) tuples.
+        """
+        if not self.path.exists():
+            return set()
+
+        with open(str(self.path), 'r', newline='') as file:
+            # A crash may leave the last line incomplete
+            lines = [line for line in file if line.endswith('\n')]
+        outcomes = (self.UPLOADED, self.NOT_FOUND, self.FAILED)
+        return set((row[0], row[1]) for row in csv.reader(lines) if len(row) == 3 and row[2] in outcomes)
+
+    def record(self, timestamp: str, url_key: str, outcome: str) -> None:
+        """
+        Record the outcome of a completed record.
+
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        :param outcome: One of UPLOADED, NOT_FOUND or FAILED.
+        """
+        with self._lock:
+            self._batch.append((timestamp, url_key, outcome))
+            if len(self._batch) >= self._batch_size or \
+                    time.monotonic() - self._last_flush >= self._flush_interval:
+                self.__flush()
+
+    def flush(self) -> None:
+        """
+        Write the current batch to disk.
+        """
+        with self._lock:
+            self.__flush()
+
+    def close(self) -> None:
+        """
+        Write the current batch to disk and close the journal.
+        """
+        with self._lock:
+            self.__flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._batch:
+            return
+
+        if self._file is None:
+            self._file = open(str(self.path), 'a', newline='')
+            # Terminate a line left incomplete by a crash
+            if self._file.tell() > 0:
+                with open(str(self.path), 'rb') as file:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        self._file.write('\n')
+        if self._before_sync is not None:
+            self._before_sync()
+        csv.writer(self._file).writerows(self._batch)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._batch = []
+
+
+class RetryQueue:
+    def __init__(self, dead_letter_path: Path = None, max_attempts: int = 5, base_delay: float = 2.0,
+                 max_delay: float = 300.0):
+        """
+        Schedules failed records for another attempt with exponential backoff and jitter. Records that fail
+        permanently, or too often, are written to a dead-letter file. The queue also keeps track of the records in
+        flight, so the fetcher knows when no more retries can follow.
+
+        :param dead_letter_path: Path to the csv file to append permanently failed records to.
+        :param max_attempts: Maximum amount of attempts per record.
+        :param base_delay: Amount of seconds to wait before the first retry, doubled for every next retry.
+        :param max_delay: Maximum amount of seconds to wait before a retry.
+        """
+        self._dead_letter_path = dead_letter_path
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._attempts = {}
+        self._scheduled = []
+        self._sequence = 0
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._scheduled)
+
+    def begin(self) -> None:
+        """
+        Register that an attempt of a record has been dispatched.
+        """
+        with self._condition:
+            self._active += 1
+
+    def complete(self, timestamp: str, url_key: str) -> None:
+        """
+        Register that a record has been finished, whatever its outcome.
+
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        """
+        with self._condition:
+            self._attempts.pop((timestamp, url_key), None)
+            self._active -= 1
+            self._condition.notify_all()
+
+    def fail(self, timestamp: str, url_key: str, reason: str, retry: bool = True) -> bool:
+        """
+        Register a failed attempt of a record, and schedule the next attempt unless the record has run out of attempts.
+
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        :param reason: Reason of the failure, written to the dead-letter file.
+        :param retry: Whether the failure is transient.
+        :return: Whether another attempt has been scheduled. If not, the record is still in flight and should be
+        completed by the caller.
+        """
+        with self._condition:
+            attempt = self._attempts.get((timestamp, url_key), 0) + 1
+            if not retry or attempt >= self._max_attempts:
+                self._attempts.pop((timestamp, url_key), None)
+                self.__write_dead_letter(timestamp, url_key, reason)
+                return False
+
+            # Exponential backoff with jitter, so failed records do not return all at once
+            delay = min(self._max_delay, self._base_delay * pow(2, attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+            self._attempts[(timestamp, url_key)] = attempt
+            self._sequence += 1
+            heapq.heappush(self._scheduled, (time.monotonic() + delay, self._sequence, timestamp, url_key))
+            self._active -= 1
+            self._condition.notify_all()
+            return True
+
+    def pop_due(self) -> List[Tuple[str, str]]:
         """
-        Counter object with a limit.
-        :param limit: Limit of the counter. Any negatives
+        Take all records whose next attempt is due.
+        :return: List of (timestamp, url_key) tuples.
         """
-        self._value = 0
-        self._limit = limit
+        due = []
+        with self._condition:
+            now = time.monotonic()
+            while self._scheduled and self._scheduled[0][0] <= now:
+                _, _, timestamp, url_key = heapq.heappop(self._scheduled)
+                due.append((timestamp, url_key))
+        return due
 
-    def increment(self):
+    def wait(self) -> bool:
         """
-        Increment counter unless limit has reached.
-        :return: Whether the increment operation was successful.
+        Block until the next attempt of a record is due.
+        :return: Whether an attempt is due. False when no attempts are scheduled and no records are in flight.
         """
-        if self._value == self._limit:
-            return False
+        with self._condition:
+            while True:
+                if self._scheduled:
+                    timeout = self._scheduled[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return True
+                elif self._active <= 0:
+                    return False
+                else:
+                    timeout = None
+                self._condition.wait(timeout)
+
+    def __write_dead_letter(self, timestamp: str, url_key: str, reason: str) -> None:
+        if self._dead_letter_path is None:
+            return
+
+        with open(str(self._dead_letter_path), 'a', newline='') as file:
+            csv.writer(file).writerow([timestamp, url_key, reason])
+
+
+def to_utf8(body: bytes, encoding: str) -> bytes:
+    """
+    Re-encode a html page as utf-8.
+
+    :param body: Raw html.
+    :param encoding: Encoding of the html.
+    :return: Html encoded as utf-8.
+    """
+    try:
+        if codecs.lookup(encoding).name == "utf-8":
+            return body
+    except LookupError:
+        encoding = "utf-8"
+    return body.decode(encoding, errors="replace").encode("utf-8")
+
+
+def minify_html(body: bytes, encoding: str) -> bytes:
+    """
+    Minify a html page using htmlmin. Runs in a worker process, as htmlmin is CPU-bound pure Python.
+
+    :param body: Raw html.
+    :param encoding: Encoding of the html.
+    :return: Minified html encoded as utf-8.
+    """
+    try:
+        html = body.decode(encoding, errors="replace")
+    except LookupError:
+        html = body.decode("utf-8", errors="replace")
+    return htmlmin.minify(html, remove_empty_space=True).encode("utf-8")
 
-        self._value += 1
-        return True
 
-    def decrement(self):
+WHITESPACE = re.compile(r"\s+")
+
+
+def compact_whitespace(body: bytes, encoding: str) -> bytes:
+    """
+    Collapse all runs of whitespace in a html page to a single space. Much faster than htmlmin, and does not need to
+    parse the page.
+
+    :param body: Raw html.
+    :param encoding: Encoding of the html.
+    :return: Compacted html encoded as utf-8.
+    """
+    try:
+        html = body.decode(encoding, errors="replace")
+    except LookupError:
+        html = body.decode("utf-8", errors="replace")
+    return WHITESPACE.sub(" ", html).encode("utf-8")
+
+
+# Minifiers run in a process pool, except when None
+MINIFIERS = {
+    "htmlmin": minify_html,
+    "whitespace": compact_whitespace,
+    "none": None,
+}
+
+
+def url_to_domain(url: str) -> str:
+    ext = tldextract.extract(url)
+    return '.'.join(part for part in (ext.subdomain, ext.domain, ext.suffix) if part)
+
+
+class ObjectStore:
+    def __init__(self, bucket_name: str, compression: str = "none"):
         """
-        Decrement counter unless the counter is zero.
-        :return: Whether the decrement operation was successful.
+        Stores every page as a separate S3 object, named {domain}/{timestamp}_{url_key}.
+
+        :param bucket_name: Name of the S3 Bucket to store the pages in.
+        :param compression: Compression of the pages, one of COMPRESSION_SUFFIXES.
         """
-        if self._value <= 0:
-            return False
+        self.bucket_name = bucket_name
+        self._compression = compression
+        self._suffix = COMPRESSION_SUFFIXES[compression]
 
-        self._value -= 1
-        return True
+    def _put_object(self, key: str, body: bytes) -> None:
+        """
+        Compress and upload a single object.
 
-    def reset(self, limit: int = 1) -> None:
+        :param key: Key of the object, without compression suffix.
+        :param body: Uncompressed body of the object.
         """
-        Reset the counter.
-        :param limit: New limit.
+        extra_args = {"ContentEncoding": self._compression} if self._compression != "none" else {}
+        bucket = s3.Bucket(self.bucket_name)
+        bucket.put_object(Key=key + self._suffix, Body=compress(body, self._compression), **extra_args)
+
+    def put(self, timestamp: str, url_key: str, body: bytes) -> None:
         """
-        self._limit = limit
-        self._value = 0
+        Store a page.
+
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        :param body: Html of the page.
+        """
+        self._put_object(f"{url_to_domain(url_key)}/{page_name(timestamp, url_key)}", body)
+
+    def sync(self) -> None:
+        """
+        Sync the pages stored so far to disk, before they are recorded as completed. Pages that have been uploaded
+        already are durable.
+        """
+        pass
+
+    def close(self) -> None:
+        """
+        Finish storing pages.
+        """
+        pass
+
+
+class ContentAddressedStore(ObjectStore):
+    def __init__(self, bucket_name: str, manifest_folder: Path, manifest_id: str, compression: str = "none",
+                 manifest_batch_size: int = 1000):
+        """
+        Stores identical pages only once, as {domain}/objects/{digest}. Pages refer to their object through the
+        manifest of their domain, {domain}/manifest-{manifest_id}.csv. Manifests are kept locally and uploaded in
+        batches, so restarts know which objects have been stored already.
+
+        :param bucket_name: Name of the S3 Bucket to store the pages in.
+        :param manifest_folder: Local folder to keep the manifests in.
+        :param manifest_id: Identifier of the manifests of this fetcher, unique for each server.
+        :param compression: Compression of the objects, one of COMPRESSION_SUFFIXES.
+        :param manifest_batch_size: Amount of new pages after which the manifest of a domain is uploaded.
+        """
+        super().__init__(bucket_name, compression)
+        self._manifest_folder = manifest_folder
+        self._manifest_name = f"{MANIFEST_PREFIX}{manifest_id}.csv"
+        self._manifest_batch_size = manifest_batch_size
+        self._stored = set()
+        self._unsent = {}
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+        # Manifests of a previous run may not have been uploaded
+        for manifest in manifest_folder.glob(f"*/{self._manifest_name}"):
+            domain = manifest.parent.name
+            self._stored.update((domain, row[2]) for row in read_manifest(manifest))
+            self._unsent[domain] = self._manifest_batch_size
+
+    def put(self, timestamp: str, url_key: str, body: bytes) -> None:
+        domain = url_to_domain(url_key)
+        digest = content_digest(body)
+        with self._lock:
+            stored = (domain, digest) in self._stored
+
+        # Identical pages uploaded at the same time are both uploaded, which is harmless
+        if not stored:
+            self._put_object(f"{domain}/{OBJECTS_FOLDER}/{digest}", body)
+
+        with self._lock:
+            self._stored.add((domain, digest))
+            if domain not in self._manifests:
+                manifest = self._manifest_folder / domain / self._manifest_name
+                manifest.parent.mkdir(parents=True, exist_ok=True)
+                self._manifests[domain] = open(str(manifest), 'a', newline='')
+            csv.writer(self._manifests[domain]).writerow([timestamp, url_key, digest, self._compression])
+            self._manifests[domain].flush()
+            self._unsent[domain] = self._unsent.get(domain, 0) + 1
+            upload = self._unsent[domain] >= self._manifest_batch_size
+            if upload:
+                self._unsent[domain] = 0
+
+        if upload:
+            self.__upload_manifest(domain)
+
+    def sync(self) -> None:
+        with self._lock:
+            for file in self._manifests.values():
+                os.fsync(file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            domains = [domain for domain, unsent in self._unsent.items() if unsent > 0]
+            self._unsent = {}
+        for domain in domains:
+            self.__upload_manifest(domain)
+
+        with self._lock:
+            for file in self._manifests.values():
+                file.close()
+            self._manifests = {}
+
+    def __upload_manifest(self, domain: str) -> None:
+        with self._lock:
+            with open(str(self._manifest_folder / domain / self._manifest_name), 'rb') as file:
+                body = file.read()
+        bucket = s3.Bucket(self.bucket_name)
+        bucket.put_object(Key=f"{domain}/{self._manifest_name}", Body=body)
+
+
+class SegmentStore(ObjectStore):
+    def __init__(self, bucket_name: str, segment_folder: Path, segment_id: str, compression: str = "none",
+                 segment_size: int = 64 * 1024 * 1024):
+        """
+        Appends pages to a rolling segment file per domain, instead of storing each page as a separate object.
+        Segments are written locally and uploaded as {domain}/segment-{segment_id}-{run}-{n}.seg with an offset index
+        once they reach segment_size.
+
+        :param bucket_name: Name of the S3 Bucket to store the segments in.
+        :param segment_folder: Local folder to write the segments in.
+        :param segment_id: Identifier of the segments of this fetcher, unique for each server.
+        :param compression: Compression of the pages within the segments, one of COMPRESSION_SUFFIXES.
+        :param segment_size: Size in bytes after which a segment is uploaded.
+        """
+        super().__init__(bucket_name, compression)
+        self._segment_folder = segment_folder
+        self._segment_prefix = f"segment-{segment_id}-{int(time.time())}"
+        self._segment_size = segment_size
+        self._segment_count = 0
+        self._writers = {}
+        self._lock = threading.Lock()
+
+        # Segments of a previous run may not have been uploaded
+        for segment in segment_folder.glob(f"*/*{SEGMENT_SUFFIX}"):
+            recover_segment(segment)
+            self.__upload_segment(segment.parent.name, segment)
+
+    def put(self, timestamp: str, url_key: str, body: bytes) -> None:
+        domain = url_to_domain(url_key)
+        name = page_name(timestamp, url_key)
+        record = encode_record(name, body, self._compression)
+        with self._lock:
+            writer = self._writers.get(domain)
+            if writer is None:
+                self._segment_count += 1
+                segment_name = f"{self._segment_prefix}-{self._segment_count:05d}{SEGMENT_SUFFIX}"
+                path = self._segment_folder / domain / segment_name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                writer = self._writers[domain] = SegmentWriter(path)
+            writer.write(name, record)
+            full = writer.size >= self._segment_size
+            if full:
+                del self._writers[domain]
+                writer.close()
+
+        if full:
+            self.__upload_segment(domain, writer.path)
+
+    def sync(self) -> None:
+        with self._lock:
+            for writer in self._writers.values():
+                writer.sync()
+
+    def close(self) -> None:
+        with self._lock:
+            writers = self._writers
+            self._writers = {}
+        for domain, writer in writers.items():
+            writer.close()
+            self.__upload_segment(domain, writer.path)
+
+    def __upload_segment(self, domain: str, path: Path) -> None:
+        bucket = s3.Bucket(self.bucket_name)
+        for file in [path, path.with_suffix(INDEX_SUFFIX)]:
+            bucket.upload_file(str(file), f"{domain}/{file.name}")
+        for file in [path, path.with_suffix(INDEX_SUFFIX)]:
+            file.unlink()
 
 
 class PageFetcher:
-    def __init__(self, bucket_name: str, limit_rate: int = 10) -> None:
+    def __init__(self, bucket_name: str, limit_rate: int = 10, burst: int = None, max_in_flight: int = None,
+                 rate_controller: str = "aimd",
+                 pool_size: int = 4, max_body_size: int = 8 * 1024 * 1024, chunk_size: int = 64 * 1024,
+                 journal_path: Path = None, download_concurrency: int = None, upload_concurrency: int = 4,
+                 queue_size: int = None, max_attempts: int = 5, dead_letter_path: Path = None,
+                 minifier: str = "htmlmin", minify_processes: int = None, store: ObjectStore = None,
+                 wayback_url: str = WAYBACK_URL, lease_queue=None, renew_interval: float = 60.0,
+                 poll_interval: float = 5.0) -> None:
         """
         Initialise PageFetcher class.
 
         :param bucket_name: Name of the S3 Bucket to store the fetched HTML files in.
         :param limit_rate: Maximum amount of requests to sent per second.
+        :param burst: Maximum amount of requests sent at once. Defaults to limit_rate.
+        :param max_in_flight: Maximum amount of unfinished requests of the asyncio engine. Defaults to 4 * limit_rate.
+        :param rate_controller: Name of the rate controller in RATE_CONTROLLERS that adapts the rate on throttling.
+        :param pool_size: Amount of keep-alive connections kept by the session of each worker thread.
+        :param max_body_size: Maximum size in bytes of a fetched page. Larger pages are aborted while streaming.
+        :param chunk_size: Size in bytes of the chunks in which pages are streamed.
+        :param journal_path: Path to the progress journal used to resume fetching. Without a journal, all records are
+        fetched.
+        :param download_concurrency: Amount of download threads of the threads engine.
+        :param upload_concurrency: Amount of upload threads.
+        :param queue_size: Maximum amount of records waiting for each stage. Defaults to twice its concurrency.
+        :param max_attempts: Maximum amount of attempts per record before it is given up.
+        :param dead_letter_path: Path to the csv file to write records to that have been given up.
+        :param minifier: Name of the minifier in MINIFIERS applied before uploading.
+        :param minify_processes: Amount of minifier processes. Defaults to the amount of cpu cores.
+        :param store: Store of the fetched pages. Defaults to an ObjectStore in the given bucket.
+        :param wayback_url: Base url of the Wayback Machine to fetch pages from.
+        :param lease_queue: LeaseQueue or LeaseClient to take records from instead of a csv file, shared by the fleet.
+        :param renew_interval: Amount of seconds between renewals of the leases being worked on.
+        :param poll_interval: Amount of seconds to wait for leases of other workers to expire or complete.
         """
         # Rate limiting and thread pooling
-        self._counter = Counter(limit_rate)
-        self._pool = Pool(pow(2, ceil(log(limit_rate) / log(2))))  # IO-Bound, thus increase pool size
-        self._error_detected = 0
-        self._cool_off_secs = 4  # 15 reqs / min (ddos rate)
-        self._ddos_mode = 0
-        self._ddos_detection_time = None
-        self._ddos_detection_timeout = 180  # 3min
+        self._bucket = TokenBucket(limit_rate, burst or limit_rate)
+        self._controller = RATE_CONTROLLERS[rate_controller](self._bucket, limit_rate)
+        # IO-Bound, thus increase pool size
+        self._download_concurrency = download_concurrency or pow(2, ceil(log(limit_rate) / log(2)))
+        self._upload_concurrency = upload_concurrency
+        self._queue_size = queue_size
+        self._download_pool = None
+        self._upload_pool = None
+        self._max_in_flight = max_in_flight or 4 * limit_rate
+        self._local = threading.local()
+        self._pool_size = pool_size
+        self._max_body_size = max_body_size
+        self._chunk_size = chunk_size
+        self._wayback_url = wayback_url.rstrip("/")
 
         # Upload
         self.bucket_name = bucket_name
+        self._store = store or ObjectStore(bucket_name)
+        self._minifier = MINIFIERS[minifier]
+        self._minify_processes = minify_processes
+        self._minify_pool = None
 
-    @staticmethod
-    def _get_url(timestamp, url_key):
-        return f"http://web.archive.org/web/{timestamp}/{url_key}"
+        # Progress
+        # Pages kept locally by the store are synced before the journal records them as uploaded
+        self._journal = ProgressJournal(journal_path, before_sync=self._store.sync) \
+            if journal_path is not None else None
+        self._retry_queue = RetryQueue(dead_letter_path, max_attempts)
 
-    def _cool_off(self):
-        time.sleep(self._cool_off_secs)
+        # Leases
+        self._lease_queue = lease_queue
+        self._renew_interval = renew_interval
+        self._poll_interval = poll_interval
+        self._worker = f"{socket.gethostname()}-{os.getpid()}"
+        self._lease_lock = threading.Lock()
+        self._leases = {}
+        self._lease_of = {}
 
-    def fetch(self, csv_path: Path, fetch_limit: int = -1) -> None:
+    def _get_url(self, timestamp, url_key):
+        return f"{self._wayback_url}/{timestamp}/{url_key}"
+
+    @property
+    def rate(self) -> float:
         """
-        Fetch HTML pages from the Internet Archive.
+        Current amount of requests per second, as set by the rate controller.
+        """
+        return self._controller.rate
+
+    def _session(self) -> requests.Session:
+        """
+        Get the session of the current worker thread, which keeps its connections to the Internet Archive alive.
+        :return: Session of the current thread.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return session
+
+    def _download(self, url: str) -> Tuple[int, List[bytes], str, Optional[str]]:
+        """
+        Download a page in chunks using the session of the current worker thread.
+
+        :param url: Url to download.
+        :return: Status code, body chunks, encoding and Retry-After header of the response.
+        """
+        with self._session().get(url, timeout=10, stream=True) as response:
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=self._chunk_size):
+                size += len(chunk)
+                if size > self._max_body_size:
+                    raise BodyTooLargeError(f"Response exceeds the maximum body size of {self._max_body_size} bytes")
+                chunks.append(chunk)
+            return response.status_code, chunks, response.encoding or "utf-8", response.headers.get("Retry-After")
+
+    async def _download_async(self, session, url: str) -> Tuple[int, List[bytes], str, Optional[str]]:
+        """
+        Download a page in chunks within the event loop.
+
+        :param session: aiohttp session holding the keep-alive connections.
+        :param url: Url to download.
+        :return: Status code, body chunks, encoding and Retry-After header of the response.
+        """
+        async with session.get(url) as response:
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(self._chunk_size):
+                size += len(chunk)
+                if size > self._max_body_size:
+                    raise BodyTooLargeError(f"Response exceeds the maximum body size of {self._max_body_size} bytes")
+                chunks.append(chunk)
+            return response.status, chunks, response.charset or "utf-8", response.headers.get("Retry-After")
+
+    def _read_records(self, csv_path: Path, fetch_limit: int = -1):
+        """
+        Read the records to fetch, skipping the records completed according to the progress journal.
 
         :param csv_path: Path to the csv data.
         :param fetch_limit: Limit to the amount of pages to be fetched. A limit of -1 means unbounded fetching from the
         supplied csv file.
+        :return: Generator of (timestamp, url_key) tuples.
         """
         if not csv_path.exists():
             raise IOError("Given csv file does not exists")
@@ -106,144 +739,446 @@ class PageFetcher:
         if fetch_limit == 0:
             raise ValueError("Nothing to fetch with a limit of 0")
 
-        try:
-            file = open("/tmp/status", "r")
-            prev_progress = int(file.read())
-            file.close()
-        except Exception:
-            prev_progress = 0
+        completed = self._journal.completed() if self._journal is not None else set()
+        if completed:
+            logging.getLogger().info(f"Skipping {len(completed)} records completed in previous runs")
 
         with open(str(csv_path), 'r') as csv_file:
             reader = csv.reader(csv_file)
             for i, line in enumerate(reader):
-                if i < prev_progress:
-                    continue
-
                 # Limit the amount of futures
                 if 0 < fetch_limit <= i:
                     break
 
-                # Convert timestamp and url_key to InternetArchive url
-                url = self._get_url(timestamp=line[0], url_key=line[1]).encode("utf-8")
+                if (line[0], line[1]) in completed:
+                    continue
 
-                while not self._counter.increment():
-                    time.sleep(0.01)
+                yield line[0], line[1]
 
-                file = open("/tmp/status", "w")
-                file.write(str(i))
-                file.close()
+    def _records(self, csv_path: Path, fetch_limit: int = -1):
+        """
+        Records to fetch, either read from the csv file or leased from the shared queue.
+        """
+        if self._lease_queue is not None:
+            return self._lease_records(fetch_limit)
+        return self._read_records(csv_path, fetch_limit)
+
+    def _lease_records(self, fetch_limit: int = -1):
+        """
+        Lease records from the shared queue. A new lease is only taken when all records of the previous lease have been
+        handed out, so a worker takes more work as it frees up. When the queue is empty, the worker keeps waiting for
+        the leases of other workers, which return to the queue if they expire. Due retries are handed out meanwhile.
+
+        :param fetch_limit: Limit to the amount of pages to be fetched, rounded up to whole leases. A limit of -1 means
+        fetching until the queue is empty.
+        :return: Generator of (timestamp, url_key) tuples.
+        """
+        if fetch_limit == 0:
+            raise ValueError("Nothing to fetch with a limit of 0")
+
+        completed = self._journal.completed() if self._journal is not None else set()
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=self.__renew_leases, args=(stop_renewing,), name="lease-renewer",
+                                   daemon=True)
+        renewer.start()
+        fetched = 0
+        try:
+            while fetch_limit < 0 or fetched < fetch_limit:
+                lease_id, records = self.__coordinate(self._lease_queue.acquire, self._worker)
+                if lease_id is None:
+                    if self.__coordinate(self._lease_queue.outstanding) == 0:
+                        return
+                    deadline = time.monotonic() + self._poll_interval
+                    while time.monotonic() < deadline:
+                        yield from self._retry_queue.pop_due()
+                        time.sleep(min(0.1, self._poll_interval))
+                    continue
+
+                logging.getLogger().info(f"Leased {len(records)} records as {lease_id}")
+                # Records completed in a previous run, or still in flight for an expired lease, are not fetched again
+                with self._lease_lock:
+                    records = [record for record in records
+                               if record not in completed and record not in self._lease_of]
+                    for record in records:
+                        self._lease_of[record] = lease_id
+                    self._leases[lease_id] = len(records)
+                if not records:
+                    self.__complete_lease(lease_id)
+
+                fetched += len(records)
+                yield from records
+        finally:
+            stop_renewing.set()
+
+    def __coordinate(self, call: Callable, *args):
+        """
+        Call the lease queue, retrying with exponential backoff while the coordinator cannot be reached, so a short
+        outage does not stop the worker.
+
+        :param call: Method of the lease queue.
+        :param args: Arguments of the method.
+        :return: Result of the method.
+        """
+        for attempt in range(1, COORDINATOR_ATTEMPTS + 1):
+            try:
+                return call(*args)
+            except requests.RequestException as e:
+                if attempt == COORDINATOR_ATTEMPTS:
+                    raise
+                delay = min(60.0, 2.0 ** attempt) * random.uniform(0.5, 1.5)
+                logging.getLogger().warning(f"{type(e).__name__} while contacting the coordinator, retrying in "
+                                            f"{delay:.1f} seconds")
+                time.sleep(delay)
+
+    def __renew_leases(self, stop: threading.Event) -> None:
+        while not stop.wait(self._renew_interval):
+            with self._lease_lock:
+                lease_ids = list(self._leases)
+            if not lease_ids:
+                continue
+            try:
+                for lease_id in self._lease_queue.renew(lease_ids):
+                    logging.getLogger().warning(f"Lease {lease_id} expired, its records may be fetched twice")
+            except Exception as e:
+                logging.getLogger().error("Could not renew leases")
+                logging.getLogger().exception(e)
+
+    def __finish_leased(self, timestamp: str, url_key: str) -> None:
+        with self._lease_lock:
+            lease_id = self._lease_of.pop((timestamp, url_key), None)
+            if lease_id is None:
+                return
+            self._leases[lease_id] -= 1
+            if self._leases[lease_id] > 0:
+                return
+        self.__complete_lease(lease_id)
+
+    def __complete_lease(self, lease_id: str) -> None:
+        with self._lease_lock:
+            self._leases.pop(lease_id, None)
+        try:
+            self._store.sync()
+            self._lease_queue.complete(lease_id)
+        except Exception as e:
+            # The lease expires and its records are fetched again
+            logging.getLogger().error(f"Could not complete lease {lease_id}")
+            logging.getLogger().exception(e)
+
+    def _with_retries(self, records):
+        """
+        Interleave records with the retries that are due.
+        :param records: Generator of (timestamp, url_key) tuples.
+        :return: Generator of (timestamp, url_key) tuples.
+        """
+        for record in records:
+            yield from self._retry_queue.pop_due()
+            yield record
+
+    def _record(self, timestamp: str, url_key: str, outcome: str) -> None:
+        if self._journal is not None:
+            self._journal.record(timestamp, url_key, outcome)
+        if self._lease_queue is not None:
+            self.__finish_leased(timestamp, url_key)
+        self._retry_queue.complete(timestamp, url_key)
+
+    def _retry(self, timestamp: str, url_key: str, reason: str, retry: bool = True) -> None:
+        """
+        Schedule another attempt of a failed record, or give it up.
+
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        :param reason: Reason of the failure.
+        :param retry: Whether the failure is transient.
+        """
+        if not self._retry_queue.fail(timestamp, url_key, reason, retry):
+            logging.getLogger().error(f"Giving up on {self._get_url(timestamp, url_key)}: {reason}")
+            self._record(timestamp, url_key, ProgressJournal.FAILED)
+
+    def close(self) -> None:
+        """
+        Flush the progress journal and the store. Records completed after closing are fetched again in the next run.
+        """
+        self._store.close()
+        if self._journal is not None:
+            self._journal.close()
+        if self._lease_queue is not None:
+            self._lease_queue.close()
+
+    def fetch(self, csv_path: Path, fetch_limit: int = -1) -> None:
+        """
+        Fetch HTML pages from the Internet Archive.
 
-                # Error cool off
-                if time.time() - self._error_detected < self._cool_off_secs:
-                    logging.getLogger().warning("Cool-off initiated")
-                    self._cool_off()
+        :param csv_path: Path to the csv data.
+        :param fetch_limit: Limit to the amount of pages to be fetched. A limit of -1 means unbounded fetching from the
+        supplied csv file.
+        """
+        self._download_pool = BoundedPool("download", self._download_concurrency, self._queue_size)
+        self.__open_upload_stage()
+
+        def submit(timestamp: str, url_key: str) -> None:
+            # Convert timestamp and url_key to InternetArchive url
+            url = self._get_url(timestamp=timestamp, url_key=url_key).encode("utf-8")
+
+            self._bucket.acquire()
+
+            self._retry_queue.begin()
+            self._download_pool.apply_async(
+                self._download,
+                [url],
+                callback=partial(self.__on_success, timestamp=timestamp, url_key=url_key),
+                error_callback=partial(self.__on_error, timestamp=timestamp, url_key=url_key)
+            )
+
+        try:
+            for timestamp, url_key in self._with_retries(self._records(csv_path, fetch_limit)):
+                submit(timestamp, url_key)
+
+            # Retry failed records until all records have been finished
+            while self._retry_queue.wait():
+                for timestamp, url_key in self._retry_queue.pop_due():
+                    submit(timestamp, url_key)
+        finally:
+            # Downloads submit uploads, thus wait for the downloads first
+            self._download_pool.join()
+            self.__close_upload_stage()
+
+    def fetch_async(self, csv_path: Path, fetch_limit: int = -1) -> None:
+        """
+        Fetch HTML pages from the Internet Archive using a single event loop. Requests are paced by a token bucket,
+        bounded by max_in_flight and share keep-alive connections to the Internet Archive.
+
+        :param csv_path: Path to the csv data.
+        :param fetch_limit: Limit to the amount of pages to be fetched. A limit of -1 means unbounded fetching from the
+        supplied csv file.
+        """
+        if aiohttp is None:
+            raise ImportError("The asyncio engine requires aiohttp, install it using 'pip install aiohttp'")
+
+        self.__open_upload_stage()
+        try:
+            asyncio.run(self.__fetch_async(csv_path, fetch_limit))
+        finally:
+            self.__close_upload_stage()
+
+    def __open_upload_stage(self) -> None:
+        self._upload_pool = BoundedPool("upload", self._upload_concurrency, self._queue_size)
+        if self._minifier is not None:
+            # Forking a process that runs threads may copy held locks, thus start fresh interpreters
+            self._minify_pool = ProcessPoolExecutor(self._minify_processes,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+
+    def __close_upload_stage(self) -> None:
+        self._upload_pool.join()
+        if self._minify_pool is not None:
+            self._minify_pool.shutdown()
+            self._minify_pool = None
+
+    async def __fetch_async(self, csv_path: Path, fetch_limit: int) -> None:
+        in_flight = asyncio.Semaphore(self._max_in_flight)
+        tasks = set()
+
+        def on_done(task: asyncio.Task) -> None:
+            tasks.discard(task)
+            in_flight.release()
+
+        connector = aiohttp.TCPConnector(limit=self._max_in_flight, keepalive_timeout=30, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def submit(timestamp: str, url_key: str) -> None:
+                await in_flight.acquire()
+                await self._bucket.acquire_async()
 
-                self._pool.apply_async(
-                    requests.get,
-                    [url],
-                    dict(timeout=10),
-                    callback=partial(self.__on_success, timestamp=line[0], url_key=line[1]),
-                    error_callback=partial(self.__on_error, url=url)
-                )
+                self._retry_queue.begin()
+                task = asyncio.ensure_future(self.__fetch_one_async(session, timestamp, url_key))
+                tasks.add(task)
+                task.add_done_callback(on_done)
 
-    @staticmethod
-    def __url_to_domain(url: str) -> str:
-        ext = tldextract.extract(url)
-        return '.'.join(part for part in ext if part)
+            # Reading records may wait for leases, thus keep it off the event loop
+            loop = asyncio.get_event_loop()
+            records = self._with_retries(self._records(csv_path, fetch_limit))
+            while True:
+                record = await loop.run_in_executor(None, next, records, None)
+                if record is None:
+                    break
+                await submit(*record)
+
+            # Retry failed records until all records have been finished
+            while await loop.run_in_executor(None, self._retry_queue.wait):
+                for timestamp, url_key in self._retry_queue.pop_due():
+                    await submit(timestamp, url_key)
+
+            if tasks:
+                await asyncio.wait(tasks)
+
+    async def __fetch_one_async(self, session, timestamp: str, url_key: str) -> None:
+        """
+        Fetch a single HTML page within the event loop.
 
-    def __on_success(self, response: Response, timestamp: str, url_key: str) -> None:
+        :param session: aiohttp session holding the keep-alive connections.
+        :param timestamp: Timestamp from IA.
+        :param url_key: Url_key from IA.
+        """
+        url = self._get_url(timestamp, url_key)
+        try:
+            status_code, chunks, encoding, retry_after = await self._download_async(session, url)
+        except Exception as e:
+            self.__handle_exception(e, timestamp, url_key)
+            return
+
+        if self.__handle_response(status_code, chunks, encoding, retry_after, timestamp, url_key):
+            # Wait for room in the upload queue without blocking the event loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, partial(self.__upload_s3, timestamp, url_key, chunks, encoding))
+
+    def __on_success(self, response: Tuple[int, List[bytes], str, Optional[str]], timestamp: str,
+                     url_key: str) -> None:
         """
         Success callback for a GET request. Does not automatically mean the request was successful, only that there were
         no exceptions.
-        :param response: Response from the request.
+        :param response: Status code, body chunks, encoding and Retry-After header of the response.
         :param timestamp: Timestamp from IA, used for logging and traceability.
         :param url_key: Url_key from IA, used for logging and traceability.
         """
-        if self._ddos_mode > 0:
-            self._error_detected = time.time()
-            if self._ddos_mode > 10:
-                self._error_detected += 300  # 5min timeout
-                logging.getLogger().error("Preventing block with 5 min timeout")
-                self._ddos_mode = 1
-            if time.time() - self._ddos_detection_time > self._ddos_detection_timeout:
-                self._ddos_mode = 0
-                self._ddos_detection_time = None
-                logging.getLogger().warning("Disabling DDOS Mode")
+        status_code, chunks, encoding, retry_after = response
+        if self.__handle_response(status_code, chunks, encoding, retry_after, timestamp, url_key):
+            self.__upload_s3(timestamp, url_key, chunks, encoding)
 
+    def __handle_response(self, status_code: int, chunks: List[bytes], encoding: str, retry_after: Optional[str],
+                          timestamp: str, url_key: str) -> bool:
+        """
+        Handle a finished GET request, regardless of the engine that sent it.
+        :param status_code: HTTP status code of the response.
+        :param chunks: Body of the response as received.
+        :param encoding: Encoding of the body.
+        :param retry_after: Retry-After header of the response.
+        :param timestamp: Timestamp from IA, used for logging and traceability.
+        :param url_key: Url_key from IA, used for logging and traceability.
+        :return: Whether the page should be uploaded.
+        """
         url = self._get_url(timestamp, url_key)
-        self._counter.decrement()
-        if response.ok:  # Status code: 2xx
-            logging.getLogger().info(f'{response.status_code}: {url}')
-            self.__upload_s3(timestamp, url_key, response.text)
-        elif response.status_code == 404:
-            logging.getLogger().warning(f'{response.status_code}: {url}')
-        elif response.status_code == 429:
-            logging.getLogger().error("DDOS prevention detected. Stopping requests to prevent ban")
-            self._counter.reset(1)
-            self._ddos_mode += 1
-            if self._ddos_detection_time is None:
-                self._ddos_detection_time = time.time()
+        if status_code == 429 or status_code >= 500:
+            self._controller.on_throttle(parse_retry_after(retry_after))
+        else:
+            self._controller.on_success()
+
+        if status_code < 400:  # Status code: 2xx
+            logging.getLogger().info(f'{status_code}: {url}')
+            return True
+        elif status_code == 404:
+            logging.getLogger().warning(f'{status_code}: {url}')
+            self._record(timestamp, url_key, ProgressJournal.NOT_FOUND)
+        elif status_code == 429:
+            logging.getLogger().error(f"DDOS prevention detected, decreasing rate: {url}")
+            self._retry(timestamp, url_key, str(status_code))
         else:
-            print(f"Code: {response.status_code} | {url}")
-            logging.getLogger().error(f'{response.status_code}: {url} ||| {response.text}|||')
+            print(f"Code: {status_code} | {url}")
+            text = b"".join(chunks).decode(encoding, errors="replace")
+            logging.getLogger().error(f'{status_code}: {url} ||| {text}|||')
+            self._retry(timestamp, url_key, str(status_code), retry=status_code >= 500)
+        return False
 
-    def __on_error(self, ex: Exception, url: str) -> None:
+    def __on_error(self, ex: Exception, timestamp: str, url_key: str) -> None:
         """
         Error callback for a GET request.
 
         :param ex: Exception that has occurred.
-        :param url: Url that triggered an exception, used for traceability.
+        :param timestamp: Timestamp from IA, used for logging and traceability.
+        :param url_key: Url_key from IA, used for logging and traceability.
+        """
+        self.__handle_exception(ex, timestamp, url_key)
+
+    def __handle_exception(self, ex: Exception, timestamp: str, url_key: str) -> None:
         """
-        self._error_detected = time.time()
-        self._counter.decrement()
-        logging.getLogger().error(f"Exception occurred while fetching {url}")
+        Handle a GET request that raised an exception, regardless of the engine that sent it.
+
+        :param ex: Exception that has occurred.
+        :param timestamp: Timestamp from IA, used for logging and traceability.
+        :param url_key: Url_key from IA, used for logging and traceability.
+        """
+        if isinstance(ex, THROTTLE_EXCEPTIONS):
+            self._controller.on_throttle()
+        logging.getLogger().error(f"Exception occurred while fetching {self._get_url(timestamp, url_key)}")
         logging.getLogger().exception(ex)
+        self._retry(timestamp, url_key, type(ex).__name__, retry=not isinstance(ex, BodyTooLargeError))
+
+    def minify(self, timestamp: str, url_key: str, body: bytes, encoding: str) -> bytes:
+        """
+        Minify a html page in the minifier process pool. Waiting for the result releases the GIL, so the network
+        threads keep running meanwhile.
+
+        :param timestamp: Timestamp from IA, used for logging and traceability.
+        :param url_key: Url_key from IA, used for logging and traceability.
+        :param body: Raw html.
+        :param encoding: Encoding of the html.
+        :return: Minified html encoded as utf-8. Falls back to the raw html if it cannot be minified, as fetching it
+            again would fail in the same way.
+        """
+        if self._minify_pool is None:
+            return to_utf8(body, encoding)
 
-    def upload(self, timestamp: str, url_key: str, html: str):
         try:
-            encoded_string = htmlmin.minify(html, remove_empty_space=True).encode("utf-8")
-        except (htmlmin.parser.OpenTagNotFoundError, NotImplementedError) as e:
-            logging.getLogger().warning("Could not parse " + self._get_url(timestamp, url_key))
-            encoded_string = html
+            return self._minify_pool.submit(self._minifier, body, encoding).result()
+        except Exception as e:
+            logging.getLogger().warning(f"Could not minify {self._get_url(timestamp, url_key)}: {type(e).__name__}")
+            return to_utf8(body, encoding)
 
-        s3_path = f"{self.__url_to_domain(url_key)}/{timestamp}_{url_key.replace('/', '_')}"
-        bucket = s3.Bucket(self.bucket_name)
-        bucket.put_object(Key=s3_path, Body=encoded_string)
+    def upload(self, timestamp: str, url_key: str, chunks: List[bytes], encoding: str):
+        encoded_string = self.minify(timestamp, url_key, b"".join(chunks), encoding)
 
-    def __upload_s3(self, timestamp: str, url_key: str, html: str) -> None:
+        self._store.put(timestamp, url_key, encoded_string)
+
+    def __upload_s3(self, timestamp: str, url_key: str, chunks: List[bytes], encoding: str) -> None:
         """
-        Upload html file to a S3 bucket.
+        Upload html file to a S3 bucket. Blocks while the upload queue is full.
 
         :param timestamp: Timestamp from IA, used for filepath.
         :param url_key: Url_key from IA, used for filepath.
-        :param html: Html to be uploaded.
+        :param chunks: Html chunks to be uploaded.
+        :param encoding: Encoding of the html chunks.
         """
         url = self._get_url(timestamp, url_key)
-        self._pool.apply_async(
+        self._upload_pool.apply_async(
             self.upload,
-            [timestamp, url_key, html],
-            callback=partial(self.success_callback, url_=url),
-            error_callback=partial(self.error_callback, url_=url)
+            [timestamp, url_key, chunks, encoding],
+            callback=partial(self.success_callback, url_=url, timestamp=timestamp, url_key=url_key),
+            error_callback=partial(self.error_callback, url_=url, timestamp=timestamp, url_key=url_key)
         )
 
-    def success_callback(self, _, url_: str) -> None:
+    def success_callback(self, _, url_: str, timestamp: str, url_key: str) -> None:
         logging.getLogger().info(f'Successfully uploaded {url_}')
+        self._record(timestamp, url_key, ProgressJournal.UPLOADED)
 
-    def error_callback(self, ex: Exception, url_: str) -> None:
+    def error_callback(self, ex: Exception, url_: str, timestamp: str, url_key: str) -> None:
         logging.getLogger().error(f"Exception occurred while uploading {url_}")
         logging.getLogger().exception(ex)
-        if ex is MemoryError:
+        if isinstance(ex, MemoryError):
             print("############EXITING############")
-            self._pool.shutdown()
-            exit(1)
+            self.close()
+            os._exit(1)
+        self._retry(timestamp, url_key, type(ex).__name__, retry=isinstance(ex, TRANSIENT_UPLOAD_EXCEPTIONS))
 
     def __getstate__(self):
         self_dict = self.__dict__.copy()
-        del self_dict['_pool']
+        del self_dict['_download_pool']
+        del self_dict['_upload_pool']
+        del self_dict['_minify_pool']
+        del self_dict['_local']
+        del self_dict['_journal']
+        del self_dict['_retry_queue']
+        del self_dict['_lease_queue']
+        del self_dict['_lease_lock']
         return self_dict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._local = threading.local()
+        self._journal = None
+        self._retry_queue = RetryQueue()
+        self._lease_queue = None
+        self._lease_lock = threading.Lock()
+        self._download_pool = None
+        self._upload_pool = None
+        self._minify_pool = None
 
 
 def init_logging(log_file: Path) -> None:
@@ -276,11 +1211,83 @@ def main():
     parser.add_argument("--data", "-d", help="Path to csv data formatted as (timestamp, url).", default="./data.csv")
     parser.add_argument("--log", "-l", help="Path to log file", default="./log.txt")
     parser.add_argument("--bucket_name", "-b", help="Amazon S3 Bucket name", default="975435234474-global-goals")
+    parser.add_argument("--journal", "-j", help="Path to the progress journal. Defaults to the data path with a "
+                                                "'.journal' suffix", default=None)
+    parser.add_argument("--dead_letter", help="Path to the csv file to write records to that failed permanently. "
+                                              "Defaults to the data path with a '.failed.csv' suffix", default=None)
+    parser.add_argument("--max_attempts", help="Maximum amount of attempts per record", type=int, default=5)
     parser.add_argument("--measure", help="Measure the performance using 500 requests", default=False)
+    parser.add_argument("--engine", help="Fetch engine to use", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--limit_rate", help="Maximum amount of requests per second", type=int, default=4)
+    parser.add_argument("--burst", help="Token bucket size", type=int, default=None)
+    parser.add_argument("--rate_controller", help="Rate controller that adapts the rate on throttling",
+                        choices=sorted(RATE_CONTROLLERS), default="aimd")
+    parser.add_argument("--max_in_flight", help="Maximum amount of unfinished requests of the asyncio engine",
+                        type=int, default=None)
+    parser.add_argument("--download_concurrency", help="Amount of download threads of the threads engine", type=int,
+                        default=None)
+    parser.add_argument("--upload_concurrency", help="Amount of upload threads", type=int, default=4)
+    parser.add_argument("--queue_size", help="Maximum amount of records waiting for each stage", type=int,
+                        default=None)
+    parser.add_argument("--minifier", help="Minifier applied before uploading", choices=sorted(MINIFIERS),
+                        default="htmlmin")
+    parser.add_argument("--minify_processes", help="Amount of minifier processes", type=int, default=None)
+    parser.add_argument("--store", help="Store pages as separate objects, only store identical pages once, or append "
+                                        "pages to segment files", choices=["objects", "dedup", "segments"],
+                        default="objects")
+    parser.add_argument("--segment_size", help="Size in bytes after which a segment is uploaded", type=int,
+                        default=64 * 1024 * 1024)
+    parser.add_argument("--compression", help="Compression of stored pages", choices=sorted(COMPRESSION_SUFFIXES),
+                        default="none")
+    parser.add_argument("--pool_size", help="Keep-alive connections per worker session", type=int, default=4)
+    parser.add_argument("--max_body_size", help="Maximum size of a fetched page in bytes", type=int,
+                        default=8 * 1024 * 1024)
+    parser.add_argument("--wayback_url", help="Base url of the Wayback Machine", default=WAYBACK_URL)
+    parser.add_argument("--s3_endpoint_url", help="Url of an S3-compatible endpoint to use instead of Amazon S3",
+                        default=None)
+    parser.add_argument("--coordinator", help="Url of a lease coordinator, or path to a SQLite lease queue on a local "
+                                              "disk, to take records from instead of the data file", default=None)
+    parser.add_argument("--lease_size", help="Maximum amount of records per lease of a SQLite lease queue", type=int,
+                        default=100)
+    parser.add_argument("--lease_timeout", help="Amount of seconds after which a lease of a SQLite lease queue "
+                                                "expires", type=float, default=600.0)
     args = parser.parse_args()
 
     init_logging(Path(args.log))
-    limit = 4
+    if args.s3_endpoint_url:
+        configure_s3(args.s3_endpoint_url)
+    limit = args.limit_rate
+
+    # Servers of a fleet share their data file name when taking leases, thus tell their manifests and segments apart
+    # by host name
+    store_id = socket.gethostname() if args.coordinator else Path(args.data).stem
+
+    def run(fetch_limit: int = -1, journal_path: Path = None, dead_letter_path: Path = None) -> None:
+        if args.store == "dedup":
+            store = ContentAddressedStore(args.bucket_name, Path(args.data).with_suffix(".manifests"), store_id,
+                                          args.compression)
+        elif args.store == "segments":
+            store = SegmentStore(args.bucket_name, Path(args.data).with_suffix(".segments"), store_id,
+                                 args.compression, args.segment_size)
+        else:
+            store = ObjectStore(args.bucket_name, args.compression)
+        lease_queue = None
+        if args.coordinator:
+            lease_queue = open_lease_queue(args.coordinator, args.lease_size, args.lease_timeout)
+        page_fetcher = PageFetcher(args.bucket_name, limit, burst=args.burst, max_in_flight=args.max_in_flight,
+                                   rate_controller=args.rate_controller,
+                                   pool_size=args.pool_size, max_body_size=args.max_body_size,
+                                   journal_path=journal_path, download_concurrency=args.download_concurrency,
+                                   upload_concurrency=args.upload_concurrency, queue_size=args.queue_size,
+                                   max_attempts=args.max_attempts, dead_letter_path=dead_letter_path,
+                                   minifier=args.minifier, minify_processes=args.minify_processes, store=store,
+                                   wayback_url=args.wayback_url, lease_queue=lease_queue)
+        if args.engine == "asyncio":
+            page_fetcher.fetch_async(Path(args.data), fetch_limit)
+        else:
+            page_fetcher.fetch(Path(args.data), fetch_limit)
+        page_fetcher.close()
+
     if args.measure:
         request_count = 500
         scores = []
@@ -289,7 +1296,7 @@ def main():
         for i in range(0, repeat):
             start = time.time()
             logging.getLogger().info(f"Started fetching {request_count} records.")
-            PageFetcher(args.bucket_name, limit).fetch(Path(args.data), request_count)
+            run(request_count)
             end = time.time()
             logging.getLogger().info(f"Finished fetching {request_count} records in {end - start} seconds.")
             print(end - start)
@@ -300,7 +1307,9 @@ def main():
     else:
         start = time.time()
         logging.getLogger().info(f"Started fetching records.")
-        PageFetcher(args.bucket_name, limit).fetch(Path(args.data))
+        journal_path = Path(args.journal) if args.journal else Path(args.data).with_suffix(".journal")
+        dead_letter_path = Path(args.dead_letter) if args.dead_letter else Path(args.data).with_suffix(".failed.csv")
+        run(journal_path=journal_path, dead_letter_path=dead_letter_path)
         end = time.time()
         logging.getLogger().info(f"Finished fetching records in {end - start} seconds.")
 
@@ -312,6 +1321,3 @@ if __name__ == '__main__':
     output, error = process.communicate()
     main()
 
-    # Sleep to allow last uploads to finish
-    sleep(10)
-
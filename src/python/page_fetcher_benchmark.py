@@ -0,0 +1,446 @@
+import argparse
+import csv
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import tempfile
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+import page_fetcher
+from page_fetcher import ContentAddressedStore, ObjectStore, PageFetcher, SegmentStore
+
+BUCKET_NAME = "benchmark"
+
+# Columns of the report, in order
+REPORT_COLUMNS = ["engine", "limit_rate", "download_concurrency", "upload_concurrency", "pool_size", "minifier",
+                  "store", "records", "requests", "uploaded", "not_found", "failed", "seconds", "records_per_second",
+                  "p50_ms", "p95_ms", "p99_ms", "cpu_seconds", "cpu_percent", "peak_rss_mib", "peak_child_rss_mib",
+                  "s3_objects", "s3_mib", "error"]
+
+
+def generate_page(size: int, seed: int) -> bytes:
+    """
+    Generate a html page resembling a captured page, with text, whitespace and links.
+
+    :param size: Approximate size of the page in bytes.
+    :param seed: Seed of the generated content.
+    :return: Html of the page.
+    """
+    rng = random.Random(seed)
+    words = ["global", "goals", "research", "university", "sustainable", "development", "climate", "education",
+             "health", "water", "energy", "partnership", "innovation", "report", "news", "about"]
+    parts = ["<!DOCTYPE html>\n<html>\n  <head>\n    <title>Benchmark page</title>\n  </head>\n  <body>\n"]
+    length = len(parts[0])
+    while length < size:
+        if rng.random() < 0.3:
+            part = f'    <a href="https://www.{rng.choice(words)}.org/{rng.choice(words)}/{rng.randint(0, 9999)}">' \
+                   f'{rng.choice(words)}</a>\n'
+        else:
+            part = "    <p>\n      " + " ".join(rng.choice(words) for _ in range(rng.randint(5, 40))) + "\n    </p>\n"
+        parts.append(part)
+        length += len(part)
+    parts.append("  </body>\n</html>\n")
+    return "".join(parts).encode("utf-8")
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 connections makes connecting the bottleneck
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients that time out or close their connections early are part of the benchmark
+        pass
+
+
+class MockWaybackServer(MockServer):
+
+    def __init__(self, latency: float = 0.05, latency_jitter: float = 0.0, not_found_ratio: float = 0.0,
+                 throttle_ratio: float = 0.0, retry_after: Optional[int] = None, page_size: int = 32 * 1024,
+                 page_variants: int = 16, seed: int = 0):
+        """
+        Local stand-in for the Wayback Machine. Serves generated pages under /web/{timestamp}/{url_key}, after a
+        configurable latency, and answers a configurable share of requests with a 404 or a 429.
+
+        :param latency: Mean time in seconds before a response is sent.
+        :param latency_jitter: Maximum deviation in seconds from the mean latency.
+        :param not_found_ratio: Share of requests answered with a 404.
+        :param throttle_ratio: Share of requests answered with a 429.
+        :param retry_after: Retry-After header of the 429 responses, if any.
+        :param page_size: Size in bytes of the served pages.
+        :param page_variants: Amount of distinct pages served, chosen by the path of the request.
+        :param seed: Seed of the served pages and of the outcome of each request.
+        """
+        super().__init__(("127.0.0.1", 0), MockWaybackHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.not_found_ratio = not_found_ratio
+        self.throttle_ratio = throttle_ratio
+        self.retry_after = retry_after
+        self.pages = [generate_page(page_size, seed + i) for i in range(page_variants)]
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/web"
+
+    def draw(self) -> tuple:
+        """
+        Draw the latency and outcome of a request.
+
+        :return: Latency in seconds and a random number deciding the status code.
+        """
+        with self._lock:
+            self.requests += 1
+            jitter = self._random.uniform(-self.latency_jitter, self.latency_jitter)
+            return max(0.0, self.latency + jitter), self._random.random()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+
+
+class MockWaybackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        latency, outcome = self.server.draw()
+        time.sleep(latency)
+
+        if not self.path.startswith("/web/"):
+            self.__respond(400, b"Bad request")
+        elif outcome < self.server.not_found_ratio:
+            self.__respond(404, b"<html><body>Not found</body></html>")
+        elif outcome < self.server.not_found_ratio + self.server.throttle_ratio:
+            headers = {"Retry-After": str(self.server.retry_after)} if self.server.retry_after is not None else {}
+            self.__respond(429, b"<html><body>Too many requests</body></html>", headers)
+        else:
+            # A stable hash, so every run serves the same page for a path
+            self.__respond(200, self.server.pages[zlib.crc32(self.path.encode('utf-8')) % len(self.server.pages)])
+
+    def __respond(self, status_code: int, body: bytes, headers: Dict[str, str] = None) -> None:
+        self.send_response(status_code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockS3Server(MockServer):
+    def __init__(self):
+        """
+        Local stand-in for S3 that accepts path-style object uploads, including multipart uploads, and only counts
+        them.
+        """
+        super().__init__(("127.0.0.1", 0), MockS3Handler)
+        self.objects = 0
+        self.bytes = 0
+        self._uploads = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def stored(self, size: int, objects: int = 1) -> None:
+        with self._lock:
+            self.objects += objects
+            self.bytes += size
+
+    def upload_id(self) -> str:
+        with self._lock:
+            self._uploads += 1
+            return str(self._uploads)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.objects = 0
+            self.bytes = 0
+
+
+class MockS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.__read_body()
+        # Parts of a multipart upload only become an object once the upload is completed
+        self.server.stored(len(body), 0 if "partNumber" in parse_qs(urlsplit(self.path).query) else 1)
+        self.__respond(200, b"", {"ETag": '"00000000000000000000000000000000"'})
+
+    def do_POST(self):
+        self.__read_body()
+        query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+        bucket, _, key = urlsplit(self.path).path.lstrip("/").partition("/")
+        if "uploads" in query:
+            result = f"<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>" \
+                     f"<UploadId>{self.server.upload_id()}</UploadId></InitiateMultipartUploadResult>"
+        else:
+            self.server.stored(0, 1)
+            result = f"<CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>" \
+                     f'<ETag>"00000000000000000000000000000000"</ETag></CompleteMultipartUploadResult>'
+        self.__respond(200, result.encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def __read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if size == 0:
+                    # Skip trailers
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def __respond(self, status_code: int, body: bytes, headers: Dict[str, str] = None) -> None:
+        self.send_response(status_code)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchmarkFetcher(PageFetcher):
+    def __init__(self, *args, **kwargs):
+        """
+        PageFetcher that records the latency of every download and the outcome of every record.
+        """
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.outcomes = {}
+        self._outcome_lock = threading.Lock()
+
+    def _download(self, url):
+        start = time.perf_counter()
+        try:
+            return super()._download(url)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def _download_async(self, session, url):
+        start = time.perf_counter()
+        try:
+            return await super()._download_async(session, url)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def _record(self, timestamp, url_key, outcome):
+        super()._record(timestamp, url_key, outcome)
+        with self._outcome_lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile.
+
+    :param values: Sorted values.
+    :param percent: Percentile between 0 and 100.
+    :return: Value at the percentile, or 0 without values.
+    """
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))]
+
+
+def write_records(path: Path, count: int) -> None:
+    """
+    Write a csv of records to fetch, formatted as (timestamp, url_key).
+
+    :param path: Path to the csv data.
+    :param count: Amount of records.
+    """
+    with open(str(path), 'w', newline='') as file:
+        writer = csv.writer(file)
+        for i in range(count):
+            writer.writerow([f"2018{i % 12 + 1:02d}01000000", f"benchmark{i % 50}.org/page/{i}"])
+
+
+def run_configuration(config: dict, wayback_url: str, s3_url: str, records: int, results) -> None:
+    """
+    Fetch all records using a single configuration. Runs in a fresh process, so the resource usage is its own.
+
+    :param config: Arguments of the configuration.
+    :param wayback_url: Base url of the mock Wayback Machine.
+    :param s3_url: Url of the S3 stand-in.
+    :param records: Amount of records to fetch.
+    :param results: Queue to put the measurements on.
+    """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    page_fetcher.configure_s3(s3_url)
+
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        logging.basicConfig(filename=str(folder / "log.txt"), level=logging.INFO)
+        data_path = folder / "data.csv"
+        write_records(data_path, records)
+
+        if config["store"] == "dedup":
+            store = ContentAddressedStore(BUCKET_NAME, folder / "manifests", "benchmark")
+        elif config["store"] == "segments":
+            store = SegmentStore(BUCKET_NAME, folder / "segments", "benchmark")
+        else:
+            store = ObjectStore(BUCKET_NAME)
+
+        fetcher = BenchmarkFetcher(BUCKET_NAME, config["limit_rate"],
+                                   download_concurrency=config["download_concurrency"],
+                                   upload_concurrency=config["upload_concurrency"], pool_size=config["pool_size"],
+                                   minifier=config["minifier"], store=store, journal_path=folder / "data.journal",
+                                   dead_letter_path=folder / "data.failed.csv", wayback_url=wayback_url)
+
+        start = time.perf_counter()
+        try:
+            if config["engine"] == "asyncio":
+                fetcher.fetch_async(data_path)
+            else:
+                fetcher.fetch(data_path)
+            fetcher.close()
+        except Exception as e:
+            results.put({"error": f"{type(e).__name__}: {e}"})
+            return
+        seconds = time.perf_counter() - start
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    latencies = sorted(fetcher.latencies)
+    completed = sum(fetcher.outcomes.values())
+    results.put({
+        "uploaded": fetcher.outcomes.get(page_fetcher.ProgressJournal.UPLOADED, 0),
+        "not_found": fetcher.outcomes.get(page_fetcher.ProgressJournal.NOT_FOUND, 0),
+        "failed": fetcher.outcomes.get(page_fetcher.ProgressJournal.FAILED, 0),
+        "seconds": round(seconds, 3),
+        "records_per_second": round(completed / seconds, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent": round(100 * cpu_seconds / seconds, 1),
+        # Linux reports the maximum resident set size in KiB
+        "peak_rss_mib": round(own.ru_maxrss / 1024, 1),
+        "peak_child_rss_mib": round(children.ru_maxrss / 1024, 1),
+    })
+
+
+def benchmark(configs: List[dict], wayback: MockWaybackServer, s3_server: MockS3Server, records: int,
+              repeat: int = 1) -> List[dict]:
+    """
+    Benchmark PageFetcher for every configuration, each in a fresh process.
+
+    :param configs: Arguments of the configurations.
+    :param wayback: Running mock Wayback Machine.
+    :param s3_server: Running S3 stand-in.
+    :param records: Amount of records fetched per run.
+    :param repeat: Amount of runs per configuration.
+    :return: Measurements of every run.
+    """
+    context = multiprocessing.get_context("spawn")
+    report = []
+    for config in configs:
+        for _ in range(repeat):
+            wayback.reset()
+            s3_server.reset()
+            results = context.Queue()
+            process = context.Process(target=run_configuration,
+                                      args=(config, wayback.url, s3_server.url, records, results))
+            process.start()
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        result = {"error": f"Exited with code {process.exitcode}"}
+                        break
+            process.join()
+
+            row = dict(config, records=records, requests=wayback.requests, s3_objects=s3_server.objects,
+                       s3_mib=round(s3_server.bytes / 1024 / 1024, 2), error="")
+            row.update(result)
+            report.append(row)
+            print(", ".join(f"{column}={row.get(column, '')}" for column in REPORT_COLUMNS if row.get(column) != ""),
+                  flush=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark page_fetcher against a local mock of the Wayback Machine '
+                                                 'and a local S3 stand-in. List arguments are combined into a grid '
+                                                 'of configurations.')
+    parser.add_argument("--records", "-n", help="Amount of records to fetch per run", type=int, default=1000)
+    parser.add_argument("--repeat", help="Amount of runs per configuration", type=int, default=1)
+    parser.add_argument("--output", "-o", help="Path to write the report to as csv", default=None)
+    parser.add_argument("--engine", help="Fetch engines", nargs="+", choices=["threads", "asyncio"],
+                        default=["threads"])
+    parser.add_argument("--limit_rate", help="Maximum amounts of requests per second", type=int, nargs="+",
+                        default=[100])
+    parser.add_argument("--download_concurrency", help="Amounts of download threads", type=int, nargs="+",
+                        default=[None])
+    parser.add_argument("--upload_concurrency", help="Amounts of upload threads", type=int, nargs="+", default=[4])
+    parser.add_argument("--pool_size", help="Keep-alive connections per worker session", type=int, nargs="+",
+                        default=[4])
+    parser.add_argument("--minifier", help="Minifiers", nargs="+", choices=sorted(page_fetcher.MINIFIERS),
+                        default=["htmlmin"])
+    parser.add_argument("--store", help="Stores", nargs="+", choices=["objects", "dedup", "segments"],
+                        default=["objects"])
+    parser.add_argument("--latency", help="Mean latency of the mock Wayback Machine in seconds", type=float,
+                        default=0.05)
+    parser.add_argument("--latency_jitter", help="Maximum deviation from the mean latency in seconds", type=float,
+                        default=0.02)
+    parser.add_argument("--not_found_ratio", help="Share of requests answered with a 404", type=float, default=0.1)
+    parser.add_argument("--throttle_ratio", help="Share of requests answered with a 429", type=float, default=0.0)
+    parser.add_argument("--retry_after", help="Retry-After header of 429 responses", type=int, default=None)
+    parser.add_argument("--page_size", help="Size of the served pages in bytes", type=int, default=32 * 1024)
+    args = parser.parse_args()
+
+    keys = ["engine", "limit_rate", "download_concurrency", "upload_concurrency", "pool_size", "minifier", "store"]
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(getattr(args, key) for key in keys))]
+
+    wayback = MockWaybackServer(args.latency, args.latency_jitter, args.not_found_ratio, args.throttle_ratio,
+                                args.retry_after, args.page_size)
+    s3_server = MockS3Server()
+    for server in (wayback, s3_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        report = benchmark(configs, wayback, s3_server, args.records, args.repeat)
+    finally:
+        wayback.shutdown()
+        s3_server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=REPORT_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import csv
+import gzip
+import hashlib
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # Only required for zstd compression
+    zstandard = None
+
+
+COMPRESSION_SUFFIXES = {
+    "none": "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+OBJECTS_FOLDER = "objects"
+MANIFEST_PREFIX = "manifest-"
+# Captures that were not fetched as they are identical to a fetched capture, written by cdx_record_fetcher
+ALIASES_SUFFIX = ".aliases.csv"
+
+# Segments are a sequence of records: a header of the compression, the name length and the body length, followed by
+# the name in utf-8 and the (compressed) body
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+SEGMENT_HEADER = struct.Struct(">BII")
+COMPRESSION_CODES = {
+    "none": 0,
+    "gzip": 1,
+    "zstd": 2,
+}
+
+
+def page_name(timestamp: str, url_key: str) -> str:
+    """
+    Name of a fetched html page, i.e. 20180806145630_uu.nl_en_research.
+
+    :param timestamp: Timestamp from IA.
+    :param url_key: Url_key from IA.
+    :return: Name of the page.
+    """
+    return f"{timestamp}_{url_key.replace('/', '_')}"
+
+
+def content_digest(body: bytes) -> str:
+    """
+    Digest used to store identical pages only once.
+
+    :param body: Html of the page.
+    :return: Hex digest of the html.
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def compress(body: bytes, compression: str) -> bytes:
+    """
+    Compress a html page.
+
+    :param body: Html of the page.
+    :param compression: One of COMPRESSION_SUFFIXES.
+    :return: Compressed html.
+    """
+    if compression == "gzip":
+        return gzip.compress(body)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard, install it using 'pip install zstandard'")
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+
+def decompress(body: bytes, compression: str) -> bytes:
+    """
+    Decompress a html page.
+
+    :param body: Compressed html of the page.
+    :param compression: One of COMPRESSION_SUFFIXES.
+    :return: Html of the page.
+    """
+    if compression == "gzip":
+        return gzip.decompress(body)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard, install it using 'pip install zstandard'")
+        return zstandard.ZstdDecompressor().decompress(body)
+    return body
+
+
+def split_compression(name: str) -> Tuple[str, str]:
+    """
+    Split the compression suffix from a file name.
+
+    :param name: File name.
+    :return: File name without the suffix and the compression.
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and name.endswith(suffix):
+            return name[:-len(suffix)], compression
+    return name, "none"
+
+
+def read_manifest(path: Path) -> Iterator[List[str]]:
+    """
+    Read a manifest, which maps pages onto content-addressed objects.
+
+    :param path: Path to the manifest.
+    :return: Generator of [timestamp, url_key, digest, compression] rows.
+    """
+    with open(str(path), 'r', newline='') as file:
+        # A crash may leave the last line incomplete
+        lines = [line for line in file if line.endswith('\n')]
+    for row in csv.reader(lines):
+        if len(row) == 4:
+            yield row
+
+
+def read_aliases(path: Path) -> Dict[str, List[str]]:
+    """
+    Read the captures that were not fetched, as their content is identical to a capture that was.
+
+    :param path: Path to the aliases csv formatted as (timestamp, url, digest, fetched timestamp, fetched url).
+    :return: Names of the pages that were not fetched, per name of the fetched page.
+    """
+    aliases = {}
+    with open(str(path), 'r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)  # Skip the header
+        for row in reader:
+            if len(row) == 5:
+                aliases.setdefault(page_name(row[3], row[4]), []).append(page_name(row[0], row[1]))
+    return aliases
+
+
+def encode_record(name: str, body: bytes, compression: str = "none") -> bytes:
+    """
+    Encode a page as a segment record.
+
+    :param name: Name of the page.
+    :param body: Html of the page.
+    :param compression: One of COMPRESSION_CODES.
+    :return: Encoded record.
+    """
+    encoded_name = name.encode("utf-8")
+    body = compress(body, compression)
+    return SEGMENT_HEADER.pack(COMPRESSION_CODES[compression], len(encoded_name), len(body)) + encoded_name + body
+
+
+class SegmentWriter:
+    def __init__(self, path: Path):
+        """
+        Appends records to a segment file. The offset index is written next to it when the segment is closed.
+
+        :param path: Path to the segment file.
+        """
+        self.path = path
+        self.index_path = path.with_suffix(INDEX_SUFFIX)
+        self._file = open(str(path), 'ab')
+        self._index = []
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+    def write(self, name: str, record: bytes) -> None:
+        """
+        Append a record.
+
+        :param name: Name of the page.
+        :param record: Record created by encode_record.
+        """
+        self._index.append((name, self._file.tell(), len(record)))
+        self._file.write(record)
+        # Hand the record to the OS, so it survives the process being killed
+        self._file.flush()
+
+    def sync(self) -> None:
+        """
+        Sync the records written so far to disk.
+        """
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """
+        Close the segment and write its offset index.
+        """
+        self._file.close()
+        with open(str(self.index_path), 'w', newline='') as file:
+            csv.writer(file).writerows(self._index)
+
+
+def iter_segment(path: Path) -> Iterator[Tuple[str, int, int]]:
+    """
+    Iterate the records of a segment without reading their bodies. An incomplete last record is skipped.
+
+    :param path: Path to the segment file.
+    :return: Generator of (page name, offset, length) tuples.
+    """
+    end = os.path.getsize(str(path))
+    with open(str(path), 'rb') as file:
+        offset = 0
+        while offset + SEGMENT_HEADER.size <= end:
+            _, name_length, body_length = SEGMENT_HEADER.unpack(file.read(SEGMENT_HEADER.size))
+            length = SEGMENT_HEADER.size + name_length + body_length
+            if offset + length > end:
+                return
+            name = file.read(name_length).decode("utf-8")
+            yield name, offset, length
+            offset += length
+            file.seek(offset)
+
+
+def recover_segment(path: Path) -> None:
+    """
+    Truncate the incomplete last record a crash may have left behind, and rebuild the offset index.
+
+    :param path: Path to the segment file.
+    """
+    index = list(iter_segment(path))
+    with open(str(path), 'ab') as file:
+        file.truncate(index[-1][1] + index[-1][2] if index else 0)
+    with open(str(path.with_suffix(INDEX_SUFFIX)), 'w', newline='') as file:
+        csv.writer(file).writerows(index)
+
+
+def read_record(path: Path, offset: int) -> bytes:
+    """
+    Read the body of a single record of a segment.
+
+    :param path: Path to the segment file.
+    :param offset: Offset of the record.
+    :return: Html of the page.
+    """
+    with open(str(path), 'rb') as file:
+        file.seek(offset)
+        code, name_length, body_length = SEGMENT_HEADER.unpack(file.read(SEGMENT_HEADER.size))
+        file.seek(name_length, os.SEEK_CUR)
+        body = file.read(body_length)
+    compression = next(name for name, value in COMPRESSION_CODES.items() if value == code)
+    return decompress(body, compression)
+
+
+def iter_documents(organisation_folder: Path) -> Iterator[Tuple[List[str], Path, Optional[int]]]:
+    """
+    List the distinct documents of an organisation, along with the names of all pages that share them. Supports
+    plain and compressed html files, content-addressed objects referenced from manifests, and records of segments.
+
+    :param organisation_folder: Folder containing the pages of a single organisation.
+    :return: Generator of (page names, path to the document, offset within a segment) tuples.
+    """
+    manifests = []
+    pages_per_object = {}
+    with os.scandir(str(organisation_folder)) as entries:
+        for entry in entries:
+            if entry.name.startswith(MANIFEST_PREFIX) and entry.name.endswith(".csv"):
+                manifests.append(entry.name)
+    for manifest in sorted(manifests):
+        for timestamp, url_key, digest, compression in read_manifest(organisation_folder / manifest):
+            object_path = organisation_folder / OBJECTS_FOLDER / (digest + COMPRESSION_SUFFIXES[compression])
+            pages_per_object.setdefault(object_path, set()).add(page_name(timestamp, url_key))
+
+    for object_path, names in pages_per_object.items():
+        yield sorted(names), object_path, None
+
+    # Scan the folder lazily, as organisations can hold millions of pages. The type of an entry is known from the
+    # scan itself, so no stat call is made per page
+    with os.scandir(str(organisation_folder)) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith(MANIFEST_PREFIX) or entry.name.endswith(INDEX_SUFFIX):
+                continue
+            path = organisation_folder / entry.name
+            if entry.name.endswith(SEGMENT_SUFFIX):
+                for name, offset, _ in iter_segment(path):
+                    yield [name], path, offset
+            else:
+                yield [split_compression(entry.name)[0]], path, None
+
+
+def read_document(path: Path, offset: Optional[int] = None) -> bytes:
+    """
+    Read a document listed by iter_documents.
+
+    :param path: Path to the document.
+    :param offset: Offset of the record within a segment, if any.
+    :return: Html of the document.
+    """
+    if offset is not None:
+        return read_record(path, offset)
+
+    with open(str(path), 'rb') as file:
+        return decompress(file.read(), split_compression(path.name)[1])
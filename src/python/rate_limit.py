@@ -0,0 +1,190 @@
+import asyncio
+import email.utils
+import logging
+import threading
+import time
+
+from typing import Optional
+
+
+def parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header, which holds either an amount of seconds or a HTTP date.
+    :param retry_after: Value of the header.
+    :return: Amount of seconds to wait, if any.
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Token bucket rate limiter, shared by threads and coroutines.
+        :param rate: Amount of tokens added to the bucket per second.
+        :param burst: Maximum amount of tokens the bucket can hold.
+        """
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Change the amount of tokens added per second. Tokens borrowed from the future keep their waiting time.
+        :param rate: New amount of tokens added to the bucket per second.
+        """
+        with self._lock:
+            self.__refill()
+            if self._tokens < 0:
+                self._tokens = self._tokens / self._rate * rate
+            self._rate = rate
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for a while, i.e. to honour a Retry-After header. Pauses do not add up: the requests
+        in flight that are throttled together all report the same Retry-After.
+        :param seconds: Amount of seconds to pause.
+        """
+        with self._lock:
+            self.__refill()
+            self._tokens = min(self._tokens, -seconds * self._rate)
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def reserve(self) -> float:
+        """
+        Take a token from the bucket. When the bucket is empty the token is borrowed from the future, so callers are
+        served in order without polling.
+        :return: Amount of seconds to wait before the token may be used.
+        """
+        with self._lock:
+            self.__refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def acquire(self) -> None:
+        """
+        Block the calling thread until a token is available.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        """
+        Suspend the calling coroutine until a token is available.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateController:
+    def __init__(self, bucket: TokenBucket, max_rate: float, report_interval: float = 60.0):
+        """
+        Rate controller that keeps the request rate fixed and only honours Retry-After headers.
+
+        :param bucket: Token bucket pacing the requests.
+        :param max_rate: Maximum amount of requests per second.
+        :param report_interval: Amount of seconds between logging the current rate.
+        """
+        self._bucket = bucket
+        self._max_rate = max_rate
+        self._report_interval = report_interval
+        self._last_report = time.monotonic()
+        self._lock = threading.Lock()
+        bucket.set_rate(max_rate)
+
+    @property
+    def rate(self) -> float:
+        """
+        Current amount of requests per second.
+        """
+        return self._bucket.rate
+
+    def on_success(self) -> None:
+        """
+        Called for every request that has not been throttled.
+        """
+        self._report()
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        """
+        Called for every request that has been throttled or timed out, or that failed on the server side.
+        :param retry_after: Amount of seconds the server asked to wait, if any.
+        """
+        if retry_after:
+            logging.getLogger().warning(f"Pausing requests for {retry_after:.0f} seconds as asked by the server")
+            self._bucket.pause(retry_after)
+        self._report()
+
+    def _report(self) -> None:
+        if time.monotonic() - self._last_report >= self._report_interval:
+            self._last_report = time.monotonic()
+            logging.getLogger().info(f"Current rate: {self.rate:.2f} requests/s")
+
+
+class AIMDRateController(RateController):
+    def __init__(self, bucket: TokenBucket, max_rate: float, min_rate: float = 0.25, increase: float = 1.0,
+                 decrease: float = 0.5, decrease_interval: float = 1.0, report_interval: float = 60.0):
+        """
+        Additive-increase/multiplicative-decrease rate controller. The rate is cut on throttling and gradually
+        recovers to max_rate while requests succeed.
+
+        :param bucket: Token bucket pacing the requests.
+        :param max_rate: Maximum amount of requests per second.
+        :param min_rate: Minimum amount of requests per second, 15 requests per minute by default.
+        :param increase: Amount of requests per second added for each second of successful requests.
+        :param decrease: Factor the rate is multiplied with on throttling.
+        :param decrease_interval: Minimum amount of seconds between decreases, so a burst of throttled requests only
+        counts once.
+        :param report_interval: Amount of seconds between logging the current rate.
+        """
+        super().__init__(bucket, max_rate, report_interval)
+        self._min_rate = min_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._decrease_interval = decrease_interval
+        self._last_decrease = 0.0
+
+    def on_success(self) -> None:
+        with self._lock:
+            rate = self.rate
+            if rate < self._max_rate:
+                # Spread the increase over the requests sent in one second
+                self._bucket.set_rate(min(self._max_rate, rate + self._increase / rate))
+        super().on_success()
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= self._decrease_interval:
+                self._last_decrease = now
+                self._bucket.set_rate(max(self._min_rate, self.rate * self._decrease))
+                logging.getLogger().warning(f"Throttling detected, decreased rate to {self.rate:.2f} requests/s")
+        super().on_throttle(retry_after)
+
+
+RATE_CONTROLLERS = {
+    "fixed": RateController,
+    "aimd": AIMDRateController,
+}
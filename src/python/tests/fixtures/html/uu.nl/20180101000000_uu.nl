@@ -0,0 +1,8 @@
+<html>
+<body>
+<a href="en/research">Research</a>
+<a href="./nl/">Nederlands</a>
+<a href="../../contact">Contact</a>
+<a href="Https://web.archive.org/web/20180101000000/http://www.unesco.org/">UNESCO</a>
+</body>
+</html>
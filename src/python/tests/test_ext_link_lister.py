@@ -0,0 +1,60 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+from ext_link_lister import ExtLinkLister, consolidate_weights, pyarrow
+
+LINKS = """aacb.org/20180806145630_aacb.org_en_a∞http://web.archive.org/web/20180806145630/https://www.un.org/en/x
+aacb.org/20180806145630_aacb.org_en_a∞http://web.archive.org/web/20180806145630/http://www.ecb.europa.eu/home
+aacb.org/20180806145630_aacb.org_en_a∞http://web.archive.org/web/20180806145630/https://www.aacb.org/un.org
+aacb.org/20180806145630_aacb.org_en_a∞mailto:info@un.org
+aacb.org/20190101000000_aacb.org_en_b∞http://web.archive.org/web/20190101000000/https://www.un.org/en/y
+aacb.org/20190101000000_aacb.org_en_b∞http://web.archive.org/web/20190101000000/https://www.un.org/en/z
+"""
+
+
+@unittest.skipIf(pyarrow is None, "Parquet output requires pyarrow")
+class WriteEdgesTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        targets_path = self.folder / "organisations.txt"
+        targets_path.write_text("un.org\necb.europa.eu\n")
+        self.links_path = self.folder / "aacb.org_links"
+        self.links_path.write_text(LINKS)
+        self.lister = ExtLinkLister("aacb.org", targets_path)
+
+    def write(self) -> Path:
+        output_folder = self.folder / "output"
+        self.lister.write_edges(self.links_path, output_folder / "edges",
+                                output_folder / "edge_weights" / "source=aacb.org" / "weights.parquet")
+        consolidate_weights(output_folder / "edge_weights", output_folder / "edge_weights.parquet")
+        return output_folder
+
+    def test_read_edges_with_pandas(self):
+        output_folder = self.write()
+        edges = pd.read_parquet(str(output_folder / "edges"))
+        self.assertEqual(len(edges), 4)
+        self.assertEqual(str(edges["timestamp"].dtype), "int64")
+        self.assertEqual(sorted(edges["source"].astype(str).unique()), ["aacb.org"])
+        self.assertEqual(sorted(edges["year"].astype(int)), [2018, 2018, 2019, 2019])
+        self.assertEqual(sorted(edges["target"]), ["ecb.europa.eu", "un.org", "un.org", "un.org"])
+
+    def test_read_weights_with_pandas(self):
+        output_folder = self.write()
+        weights = pd.read_parquet(str(output_folder / "edge_weights.parquet"))
+        self.assertEqual(list(weights.columns), ["source", "target", "year", "count"])
+        self.assertEqual(sorted(weights[["target", "year", "count"]].itertuples(index=False, name=None)),
+                         [("ecb.europa.eu", 2018, 1), ("un.org", 2018, 1), ("un.org", 2019, 2)])
+
+    def test_rewrite_replaces_partition(self):
+        self.write()
+        output_folder = self.write()
+        self.assertEqual(len(pd.read_parquet(str(output_folder / "edges"))), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
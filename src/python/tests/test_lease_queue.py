@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from lease_queue import LeaseQueue, read_records
+
+
+class LeaseQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name) / "leases.sqlite"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def queue(self, lease_timeout: float) -> LeaseQueue:
+        queue = LeaseQueue(self.path, lease_size=3, lease_timeout=lease_timeout)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_complete(self):
+        queue = self.queue(600)
+        queue.load([("20180101000000", f"un.org/{i}") for i in range(5)])
+        lease_id, records = queue.acquire("worker")
+        self.assertEqual(len(records), 3)
+        queue.complete(lease_id)
+        self.assertEqual(queue.counts(), {"pending": 2, "leased": 0, "done": 3})
+        self.assertEqual(queue.outstanding(), 0)
+
+    def test_complete_after_expiry(self):
+        # Leases expire as soon as they are taken
+        queue = self.queue(-1)
+        queue.load([("20180101000000", f"un.org/{i}") for i in range(3)])
+        lease_id, _ = queue.acquire("slow")
+        # Leases expire when the next lease is taken, a queue with leases of 0 records only expires them
+        watcher = LeaseQueue(self.path, lease_size=0)
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.acquire("other"), (None, []))
+        self.assertEqual(queue.counts(), {"pending": 3, "leased": 0, "done": 0})
+
+        # The records of the expired lease were uploaded anyway
+        queue.complete(lease_id)
+        self.assertEqual(queue.counts(), {"pending": 0, "leased": 0, "done": 3})
+        self.assertEqual(queue.acquire("other"), (None, []))
+
+    def test_complete_after_lease_taken_over(self):
+        queue = self.queue(-1)
+        queue.load([("20180101000000", f"un.org/{i}") for i in range(3)])
+        lease_id, records = queue.acquire("slow")
+        other_id, other_records = queue.acquire("other")
+        self.assertEqual(records, other_records)
+
+        # Completing the expired lease leaves the records of the lease that took them over alone
+        queue.complete(lease_id)
+        self.assertEqual(queue.counts(), {"pending": 0, "leased": 3, "done": 0})
+        queue.complete(other_id)
+        self.assertEqual(queue.counts(), {"pending": 0, "leased": 0, "done": 3})
+
+    def test_load_twice(self):
+        queue = self.queue(600)
+        records = [("20180101000000", "un.org/a"), ("20190101000000", "un.org/a")]
+        self.assertEqual(queue.load(records), 2)
+        self.assertEqual(queue.load(records), 0)
+
+
+class ReadRecordsTest(unittest.TestCase):
+    def test_skip_header(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "un.org.csv"
+            path.write_text("timestamp,url,digest\n20180101000000,un.org/a,D1\n20190101000000,un.org/b,D2\n")
+            self.assertEqual(list(read_records(path)),
+                             [("20180101000000", "un.org/a"), ("20190101000000", "un.org/b")])
+
+    def test_without_header(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "data0.csv"
+            path.write_text("20180101000000,un.org/a\n")
+            self.assertEqual(list(read_records(path)), [("20180101000000", "un.org/a")])
+
+
+if __name__ == '__main__':
+    unittest.main()
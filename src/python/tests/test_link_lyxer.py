@@ -0,0 +1,91 @@
+import tempfile
+import unittest
+from collections import defaultdict
+from pathlib import Path
+
+from link_lyxer import DELIMITER, extract_links, join_url, page_url, process_organisations
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def links_per_source(path: Path) -> dict:
+    links = defaultdict(list)
+    with open(str(path), 'r', encoding='utf-8') as file:
+        for line in file:
+            source, link = line.rstrip('\n').split(DELIMITER, 1)
+            links[source].append(link)
+    return dict(links)
+
+
+class PageUrlTest(unittest.TestCase):
+    def test_page(self):
+        self.assertEqual(page_url("20180806145630_uu.nl_en_research"),
+                         "http://web.archive.org/web/20180806145630/http://uu.nl/en/research")
+
+    def test_root_page(self):
+        self.assertEqual(page_url("20180101000000_un.org"), "http://web.archive.org/web/20180101000000/http://un.org")
+
+
+class JoinUrlTest(unittest.TestCase):
+    base = "http://web.archive.org/web/20180806145630/http://uu.nl/en/research"
+
+    def test_relative(self):
+        self.assertEqual(join_url(self.base, "publications"),
+                         "http://web.archive.org/web/20180806145630/http://uu.nl/en/publications")
+        self.assertEqual(join_url(self.base, "../../../contact"),
+                         "http://web.archive.org/web/20180806145630/http://uu.nl/contact")
+
+    def test_relative_to_root_page(self):
+        self.assertEqual(join_url(page_url("20180101000000_un.org"), "x"),
+                         "http://web.archive.org/web/20180101000000/http://un.org/x")
+
+    def test_root_relative(self):
+        self.assertEqual(join_url(self.base, "/web/20180806145630/https://www.un.org/"),
+                         "http://web.archive.org/web/20180806145630/https://www.un.org/")
+
+    def test_absolute(self):
+        self.assertEqual(join_url(self.base, "HTTPS://www.ilo.org/"), "https://www.ilo.org/")
+        self.assertEqual(join_url(self.base, "//www.ilo.org/"), "http://www.ilo.org/")
+
+
+class ExtractLinksTest(unittest.TestCase):
+    base = "http://web.archive.org/web/20180806145630/http://uu.nl/en/research"
+
+    def test_sorted_unique_without_fragments(self):
+        html = '<a href="b#1">b</a><a href="a">a</a><a href="b#2">b</a><a href="b">b</a><a href="#top">top</a>'
+        self.assertEqual(extract_links(html, self.base), [
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/a",
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/b",
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/research",
+        ])
+
+    def test_elements(self):
+        html = '<area href="area"><frame src="frame"><iframe src="iframe"></iframe><img src="img">' \
+               '<link href="link"><script src="script"></script><a name="anchor">anchor</a>'
+        self.assertEqual(extract_links(html, self.base), [
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/area",
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/frame",
+            "http://web.archive.org/web/20180806145630/http://uu.nl/en/iframe",
+        ])
+
+    def test_base(self):
+        html = '<base href="/web/20190101000000/https://www.uu.nl/nl/"><base href="https://example.org/">' \
+               '<a href="nieuws">nieuws</a>'
+        self.assertEqual(extract_links(html, self.base),
+                         ["http://web.archive.org/web/20190101000000/https://www.uu.nl/nl/nieuws"])
+
+
+class ProcessOrganisationsTest(unittest.TestCase):
+    def test_fixture_organisation(self):
+        # The expected links were derived from lynx -dump -listonly -unique_urls -hiddenlinks=merge, with the
+        # fragments removed and the links sorted per page
+        with tempfile.TemporaryDirectory() as folder:
+            output_folder = Path(folder)
+            process_organisations([FIXTURES / "html" / "uu.nl"], output_folder, output_folder / "log.txt", 1)
+            self.assertEqual(links_per_source(output_folder / "uu.nl_links"),
+                             links_per_source(FIXTURES / "links" / "uu.nl_links"))
+            self.assertFalse((output_folder / "uu.nl_links.partial").exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import csv
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import page_fetcher
+from page_fetcher import ProgressJournal, SegmentStore
+from page_store import INDEX_SUFFIX, encode_record, iter_segment, read_record
+
+
+class ProgressJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name) / "journal.csv"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_resume(self):
+        journal = ProgressJournal(self.path, batch_size=2)
+        journal.record("20180806145630", "uu.nl/en/research", ProgressJournal.UPLOADED)
+        journal.record("20180806145631", "uu.nl/en/education", ProgressJournal.NOT_FOUND)
+        journal.record("20180806145632", "uu.nl/en/news", ProgressJournal.FAILED)
+        journal.flush()
+        journal.record("20180806145633", "uu.nl/en/contact", ProgressJournal.UPLOADED)
+        # A crash loses the current batch
+        self.assertEqual(ProgressJournal(self.path).completed(), {
+            ("20180806145630", "uu.nl/en/research"),
+            ("20180806145631", "uu.nl/en/education"),
+            ("20180806145632", "uu.nl/en/news"),
+        })
+        journal.close()
+        self.assertIn(("20180806145633", "uu.nl/en/contact"), ProgressJournal(self.path).completed())
+
+    def test_missing_journal(self):
+        self.assertEqual(ProgressJournal(self.path).completed(), set())
+
+    def test_incomplete_last_line(self):
+        with open(str(self.path), 'w', newline='') as file:
+            file.write("20180806145630,uu.nl/en/research,uploaded\r\n20180806145631,uu.nl/en/educ")
+        journal = ProgressJournal(self.path)
+        self.assertEqual(journal.completed(), {("20180806145630", "uu.nl/en/research")})
+
+        journal.record("20180806145632", "uu.nl/en/news", ProgressJournal.UPLOADED)
+        journal.close()
+        with open(str(self.path), 'r', newline='') as file:
+            rows = list(csv.reader(file))
+        self.assertEqual(rows[1], ["20180806145631", "uu.nl/en/educ"])
+        self.assertEqual(ProgressJournal(self.path).completed(), {
+            ("20180806145630", "uu.nl/en/research"),
+            ("20180806145632", "uu.nl/en/news"),
+        })
+
+    def test_before_sync(self):
+        synced = []
+        journal = ProgressJournal(self.path, before_sync=lambda: synced.append(self.path.stat().st_size))
+        journal.flush()
+        self.assertEqual(synced, [])
+        journal.record("20180806145630", "uu.nl/en/research", ProgressJournal.UPLOADED)
+        journal.close()
+        # The pages are synced before the batch that records them is written
+        self.assertEqual(synced, [0])
+        self.assertGreater(self.path.stat().st_size, 0)
+
+
+class SegmentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.segment_folder = Path(self.folder.name)
+        self.uploads = {}
+        patcher = mock.patch.object(page_fetcher, "s3")
+        self.addCleanup(patcher.stop)
+        patcher.start().Bucket.return_value.upload_file.side_effect = self.upload_file
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def upload_file(self, file_name: str, key: str) -> None:
+        with open(file_name, 'rb') as file:
+            self.uploads[key] = file.read()
+
+    def test_segment_per_domain(self):
+        store = SegmentStore("bucket", self.segment_folder, "a", compression="gzip")
+        store.put("20180806145630", "uu.nl/en/research", b"<html>research</html>")
+        store.put("20180806145630", "www.un.org/", b"<html>un</html>")
+        store.put("20180806145631", "uu.nl/en/education", b"<html>education</html>")
+        store.sync()
+        self.assertEqual(self.uploads, {})
+        store.close()
+
+        segments = sorted(key for key in self.uploads if key.endswith(".seg"))
+        self.assertEqual([key.split("/")[0] for key in segments], ["uu.nl", "www.un.org"])
+        self.assertEqual(set(self.uploads), set(segments) | {key[:-4] + INDEX_SUFFIX for key in segments})
+        path = self.segment_folder / "uu.nl.seg"
+        path.write_bytes(self.uploads[segments[0]])
+        self.assertEqual([(name, read_record(path, offset)) for name, offset, _ in iter_segment(path)], [
+            ("20180806145630_uu.nl_en_research", b"<html>research</html>"),
+            ("20180806145631_uu.nl_en_education", b"<html>education</html>"),
+        ])
+        self.assertEqual(list((self.segment_folder / "uu.nl").iterdir()), [])
+
+    def test_full_segment_uploaded(self):
+        store = SegmentStore("bucket", self.segment_folder, "a", segment_size=1)
+        store.put("20180806145630", "uu.nl/en/research", b"<html>research</html>")
+        self.assertEqual(len(self.uploads), 2)
+        store.put("20180806145631", "uu.nl/en/education", b"<html>education</html>")
+        self.assertEqual(len(self.uploads), 4)
+        store.close()
+        self.assertEqual(len(self.uploads), 4)
+
+    def test_recover_previous_run(self):
+        path = self.segment_folder / "uu.nl" / "segment-a-1-00001.seg"
+        path.parent.mkdir()
+        record = encode_record("20180806145630_uu.nl_en_research", b"<html>research</html>")
+        path.write_bytes(record + record[:-1])
+
+        SegmentStore("bucket", self.segment_folder, "a")
+        self.assertEqual(self.uploads["uu.nl/segment-a-1-00001.seg"], record)
+        self.assertEqual(self.uploads["uu.nl/segment-a-1-00001.idx"],
+                         f"20180806145630_uu.nl_en_research,0,{len(record)}\r\n".encode())
+        self.assertFalse(path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
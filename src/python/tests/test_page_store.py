@@ -0,0 +1,98 @@
+import csv
+import tempfile
+import unittest
+from pathlib import Path
+
+from page_store import INDEX_SUFFIX, SEGMENT_HEADER, SegmentWriter, encode_record, iter_documents, iter_segment, \
+    read_document, read_record, recover_segment
+
+PAGES = [
+    ("20180806145630_uu.nl_en_research", b"<html>research</html>"),
+    ("20180806145630_uu.nl_en_education", b"<html>education</html>"),
+    ("20190101000000_uu.nl", b"<html>\xc3\xa9</html>"),
+]
+
+
+def read_index(path: Path) -> list:
+    with open(str(path.with_suffix(INDEX_SUFFIX)), 'r', newline='') as file:
+        return [(name, int(offset), int(length)) for name, offset, length in csv.reader(file)]
+
+
+class EncodeRecordTest(unittest.TestCase):
+    def test_framing(self):
+        self.assertEqual(encode_record("a", b"bc"), b"\x00" b"\x00\x00\x00\x01" b"\x00\x00\x00\x02" b"a" b"bc")
+
+    def test_utf8_name(self):
+        record = encode_record("é", b"")
+        self.assertEqual(SEGMENT_HEADER.unpack(record[:SEGMENT_HEADER.size]), (0, 2, 0))
+        self.assertEqual(record[SEGMENT_HEADER.size:], "é".encode("utf-8"))
+
+    def test_gzip(self):
+        code, _, body_length = SEGMENT_HEADER.unpack(encode_record("a", b"bc" * 100, "gzip")[:SEGMENT_HEADER.size])
+        self.assertEqual(code, 1)
+        self.assertLess(body_length, 200)
+
+
+class SegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name) / "uu.nl" / "segment-a-1-00001.seg"
+        self.path.parent.mkdir()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write_segment(self, compression: str = "none") -> None:
+        writer = SegmentWriter(self.path)
+        for name, body in PAGES:
+            writer.write(name, encode_record(name, body, compression))
+        writer.close()
+
+    def test_round_trip(self):
+        self.write_segment("gzip")
+        records = list(iter_segment(self.path))
+        self.assertEqual([name for name, _, _ in records], [name for name, _ in PAGES])
+        self.assertEqual([read_record(self.path, offset) for _, offset, _ in records], [body for _, body in PAGES])
+        self.assertEqual(read_index(self.path), records)
+
+    def test_records_visible_before_close(self):
+        writer = SegmentWriter(self.path)
+        name, body = PAGES[0]
+        writer.write(name, encode_record(name, body))
+        self.assertEqual([record[0] for record in iter_segment(self.path)], [name])
+        writer.close()
+
+    def test_recover_incomplete_record(self):
+        self.write_segment()
+        size = self.path.stat().st_size
+        record = encode_record("20200101000000_uu.nl", b"<html>lost</html>")
+        for length in [SEGMENT_HEADER.size - 1, SEGMENT_HEADER.size + 3, len(record) - 1]:
+            with self.subTest(length=length):
+                with open(str(self.path), 'ab') as file:
+                    file.write(record[:length])
+                self.assertEqual(len(list(iter_segment(self.path))), len(PAGES))
+                self.path.with_suffix(INDEX_SUFFIX).unlink()
+                recover_segment(self.path)
+                self.assertEqual(self.path.stat().st_size, size)
+                self.assertEqual(read_index(self.path), list(iter_segment(self.path)))
+
+    def test_recover_empty_segment(self):
+        with open(str(self.path), 'wb') as file:
+            file.write(b"\x00\x00")
+        recover_segment(self.path)
+        self.assertEqual(self.path.stat().st_size, 0)
+        self.assertEqual(read_index(self.path), [])
+
+    def test_iter_documents(self):
+        self.write_segment()
+        with open(str(self.path.parent / "20170101000000_uu.nl"), 'wb') as file:
+            file.write(b"<html>plain</html>")
+        documents = {tuple(names): read_document(path, offset)
+                     for names, path, offset in iter_documents(self.path.parent)}
+        expected = {(name,): body for name, body in PAGES}
+        expected[("20170101000000_uu.nl",)] = b"<html>plain</html>"
+        self.assertEqual(documents, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()